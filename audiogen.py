@@ -4,99 +4,553 @@ import glob
 import json
 import secrets
 import io
+import hashlib
+import mmap
+import struct
+import subprocess
+import tempfile
+import threading
+import wave
+import weakref
+from bisect import bisect_right
+from collections import deque
 
 from pydub import AudioSegment
+from pydub.exceptions import CouldntEncodeError
+from metrics import stage_seconds
+
+try:
+    import audioop
+except ImportError:
+    import pyaudioop as audioop # python 3.13+, same fallback as pydub
+
+try:
+    import lameenc # LAME linked into the process, so mp3 needs no ffmpeg
+except ImportError:
+    lameenc = None
+
+MANIFEST_VERSION = 1
+
+_generators = weakref.WeakSet()
+
+
+def _after_fork():
+    for generator in list(_generators):
+        generator._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _refill_bank(ref):
+    # holds only a weak reference, so a generator dropped by a reload takes its thread with it
+    while True:
+        generator = ref()
+        if generator is None or not generator._refill_once():
+            return
+        del generator
+
+
+class Mp3Encoder:
+    """
+    mp3 at 64 kbit/s. Encoded in process by lameenc (in requirements.txt). Without it, every encode
+    starts new ffmpeg (or avconv) processes, nothing is kept running.
+    """
+    name = "mp3"
+    media_type = "audio/mpeg"
+
+    def __init__(self, config):
+        self.workers = int(config.get("encode_workers", min(4, os.cpu_count() or 1)))
+        self.needs_ffmpeg = lameenc is None
+
+    def encode(self, segments):
+        if lameenc is not None:
+            return [self._encode_lame(segment) for segment in segments]
+        return self._encode_ffmpeg(segments)
+
+    def _encode_lame(self, segment):
+        if not segment.raw_data:
+            # AudioSegment.empty() says 1 Hz, which LAME refuses
+            segment = AudioSegment.silent(duration=0, frame_rate=44100)
+        segment = segment.set_sample_width(2)
+        encoder = lameenc.Encoder() # an encoder is done after flush(), so one per frame (no process, just a struct)
+        encoder.set_bit_rate(64)
+        encoder.set_in_sample_rate(segment.frame_rate)
+        encoder.set_channels(segment.channels)
+        encoder.set_quality(5) # LAME's default, what ffmpeg's libmp3lame uses too
+        return bytes(encoder.encode(bytes(segment.raw_data)) + encoder.flush())
+
+    def _encode_ffmpeg(self, segments):
+        """
+        Encodes a whole challenge worth of segments to mp3 bytes (same settings as AudioGenerator.segment_to_base64).
+        Instead of one ffmpeg process per segment, the segments are split into at most
+        encode_workers chunks and each chunk is encoded by one ffmpeg process with one
+        input and one output per segment. The chunks are encoded in parallel.
+        """
+        if not segments:
+            return []
+        workers = max(1, min(self.workers, len(segments)))
+        per_proc = -(-len(segments) // workers)
+        with tempfile.TemporaryDirectory(prefix="tinac_enc_") as tmp:
+            jobs = []
+            for start in range(0, len(segments), per_proc):
+                command = [AudioSegment.converter, "-y", "-loglevel", "error"]
+                outputs = []
+                for i in range(start, min(start + per_proc, len(segments))):
+                    wav_path = os.path.join(tmp, f"{i}.wav")
+                    segments[i].export(wav_path, format="wav") # pure python, no ffmpeg for wav
+                    command.extend(["-f", "wav", "-i", wav_path])
+                for n, i in enumerate(range(start, min(start + per_proc, len(segments)))):
+                    mp3_path = os.path.join(tmp, f"{i}.mp3")
+                    command.extend(["-map", f"{n}:a", "-b:a", "64k", "-f", "mp3", mp3_path])
+                    outputs.append(mp3_path)
+                with open(os.devnull, "rb") as devnull:
+                    proc = subprocess.Popen(command, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                jobs.append((proc, outputs))
+            errors = [(proc, proc.communicate()[1]) for proc, _ in jobs]
+            for proc, err in errors:
+                if proc.returncode != 0:
+                    raise CouldntEncodeError(f"Encoding failed. ffmpeg/avlib returned error code: {proc.returncode}\n\n{err.decode(errors='ignore')}")
+            results = []
+            for _, outputs in jobs:
+                for mp3_path in outputs:
+                    with open(mp3_path, "rb") as f:
+                        results.append(f.read())
+        return results
+
+
+class WavEncoder:
+    """
+    16 bit mono PCM WAV at audio_sample_rate, written in process with the wave module.
+    Larger than mp3, but no subprocess and the same cost for every frame.
+    """
+    name = "wav"
+    media_type = "audio/wav"
+    needs_ffmpeg = False
+
+    def __init__(self, config):
+        self.sample_rate = int(config.get("audio_sample_rate", 16000))
+
+    def _pcm(self, segment):
+        return segment.set_channels(1).set_sample_width(2).set_frame_rate(self.sample_rate).raw_data
+
+    def encode(self, segments):
+        results = []
+        for segment in segments:
+            buffer = io.BytesIO()
+            with wave.open(buffer, "wb") as f:
+                f.setnchannels(1)
+                f.setsampwidth(2)
+                f.setframerate(self.sample_rate)
+                f.writeframes(self._pcm(segment))
+            results.append(buffer.getvalue())
+        return results
+
+
+class UlawEncoder(WavEncoder):
+    """
+    8 bit mu-law WAV (format tag 7) at audio_sample_rate, half the size of "wav".
+    The wave module only writes PCM, so the header is built here.
+    """
+    name = "ulaw"
+
+    def encode(self, segments):
+        results = []
+        for segment in segments:
+            data = audioop.lin2ulaw(self._pcm(segment), 2)
+            pad = b"\0" * (len(data) % 2)
+            fmt = struct.pack("<HHIIHHH", 7, 1, self.sample_rate, self.sample_rate, 1, 8, 0)
+            chunks = b"".join([
+                b"fmt ", struct.pack("<I", len(fmt)), fmt,
+                b"fact", struct.pack("<II", 4, len(data)),
+                b"data", struct.pack("<I", len(data)), data, pad,
+            ])
+            results.append(b"RIFF" + struct.pack("<I", 4 + len(chunks)) + b"WAVE" + chunks)
+        return results
+
+
+ENCODERS = {"mp3": Mp3Encoder, "wav": WavEncoder, "ulaw": UlawEncoder}
+
+
+def create_encoder(config):
+    """
+    Returns the encoder selected by "audio_format" in config.json.
+    """
+    name = config.get("audio_format", "mp3")
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown audio_format {name!r}, use one of: {', '.join(ENCODERS)}.")
+    return ENCODERS[name](config)
+
+
 class AudioGenerator:
-    def __init__(self, config_path="config.json"):
+    def __init__(self, config_path="config.json", use_manifest=True):
         with open(config_path, 'r') as f:
             self.config = json.load(f)
-        self.num_files = self._index_nums()
-        durs = []
-        for digit in self.num_files:
-            for path in self.num_files[digit]:
-                durs.append(len(AudioSegment.from_wav(path)))
-        self.max_num_len = max(durs) if durs else 700
-        self.min_num_len = min(durs) if durs else 500
-        total_ms = 0
-        count = 0
-        for digit in self.num_files:
-            for path in self.num_files[digit]:
-                total_ms += len(AudioSegment.from_wav(path))
-                count += 1
-        self.sdur = total_ms / count if count > 0 else 500
+        self.cache_dir = self.config.get("audio_cache_dir", "audio/.cache")
+        self.encoder = create_encoder(self.config)
+        self._mp3 = self.encoder if isinstance(self.encoder, Mp3Encoder) else Mp3Encoder(self.config)
+        self.manifest_path = self.config.get("audio_manifest", "audio/manifest.json")
+        # decoded audio and fitted digit clips, both filled on first use
+        self.pcm = {}
+        self.fitted = {}
+        manifest = self._load_manifest() if use_manifest else None
+        scanned = manifest is None
+        if scanned:
+            manifest = self._scan_assets()
+        self.manifest = manifest
+        self.manifest_hash = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+        self.num_files = {str(i): [] for i in range(10)}
+        for path in manifest["numbers"]:
+            self.num_files[os.path.basename(path)[0]].append(path)
+        stats = manifest["stats"]
+        self.max_num_len = stats["max_num_len"]
+        self.min_num_len = stats["min_num_len"]
+        self.sdur = stats["sdur"]
         gapval = self.config.get("gap","500")
         self.gap = float(gapval) if not gapval.endswith("%") else (self.sdur * float(gapval[:-1]) / 100)
+        self._gaps = {}
         sources = []
-        for json_path in glob.glob(f"audio/aligned/*.json"):
-            mp3_path = json_path.replace(".json", ".mp3")
-            if os.path.exists(mp3_path):
-                with open(json_path, 'r') as f:
-                    data = json.load(f)
-                    number_words = {"zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine"}
-                    safe_zones = [
-                        w for w in data.get("words", [])
-                        if w.get("case") == "success" and w["word"].lower() not in number_words
-                    ]
-                if safe_zones:
-                    sources.append({"audio": mp3_path, "zones": safe_zones})
+        for source in manifest["sources"]:
+            zones = source["zones"]
+            durs = [(w["end"] - w["start"]) * 1000 for w in zones]
+            sources.append({"audio": source["audio"], "zones": zones, "durs": durs})
         self.decoy_sources = sources
+        if scanned:
+            # every file was just read anyway, with a manifest the cache is pruned when it is rebuilt
+            self._prune_cache()
+        # ready decoy snippets per source, filled by a background thread. Each snippet is used once,
+        # a snippet showing up in two frames would tell the decoys apart from the real frame.
+        bank_size = max(0, int(self.config.get("audio_bank_size", 256)))
+        self.bank_capacity = -(-bank_size // len(sources)) if sources else 0
+        self._bank = [deque() for _ in sources]
+        self._bank_cond = threading.Condition()
+        self._bank_thread = None
+        self._closed = False
+        self.bank_hits = 0
+        self.bank_misses = 0
+        _generators.add(self)
+
+    def _after_fork(self):
+        # the refill thread does not exist in the child, and its snippets must not be shared with the parent
+        self._bank_cond = threading.Condition()
+        self._bank_thread = None
+        self._bank = [deque() for _ in self.decoy_sources]
+
+    def close(self):
+        """
+        Stops the refill thread and drops the ready snippets.
+        """
+        with self._bank_cond:
+            self._closed = True
+            for bank in self._bank:
+                bank.clear()
+            self._bank_cond.notify_all()
+
+    def _start_bank(self):
+        if self.bank_capacity == 0 or self._closed:
+            return
+        with self._bank_cond:
+            if self._bank_thread is None:
+                self._bank_thread = threading.Thread(target=_refill_bank, args=(weakref.ref(self),), name="audio-bank", daemon=True)
+                self._bank_thread.start()
+
+    def _refill_once(self):
+        """
+        Adds one snippet to the emptiest bank, after waiting (up to a second) for one to have room.
+        Returns False once the generator is closed.
+        """
+        with self._bank_cond:
+            if self._closed:
+                return False
+            i = min(range(len(self._bank)), key=lambda i: len(self._bank[i]))
+            if len(self._bank[i]) >= self.bank_capacity:
+                self._bank_cond.wait(1.0)
+                return not self._closed
+        snippet = self._make_snippet(i)
+        with self._bank_cond:
+            if not self._closed:
+                self._bank[i].append(snippet)
+        return True
+
+    def _take_snippets(self, i, count):
+        """
+        Returns count snippets of decoy source i, from its bank as far as it has them and made here otherwise.
+        """
+        self._start_bank()
+        with self._bank_cond:
+            bank = self._bank[i]
+            snippets = [bank.popleft() for _ in range(min(count, len(bank)))]
+            self.bank_hits += len(snippets)
+            self.bank_misses += count - len(snippets)
+            self._bank_cond.notify()
+        while len(snippets) < count:
+            snippets.append(self._make_snippet(i))
+        return snippets
+
+    def bank_report(self):
+        with self._bank_cond:
+            return {"ready": sum(len(bank) for bank in self._bank), "capacity": self.bank_capacity * len(self._bank), "hits": self.bank_hits, "misses": self.bank_misses}
+
+    @staticmethod
+    def _chapter_audio(json_path):
+        # a chapter can be a .wav instead of an .mp3, which pydub reads without ffmpeg
+        for ext in (".mp3", ".wav"):
+            path = json_path[:-len(".json")] + ext
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _asset_files(self):
+        """
+        Returns {path: [size, mtime_ns]} of every file the manifest is built from.
+        """
+        paths = glob.glob("audio/numbers/*.wav")
+        for json_path in glob.glob("audio/aligned/*.json"):
+            audio_path = self._chapter_audio(json_path)
+            if audio_path is not None:
+                paths.extend([json_path, audio_path])
+        files = {}
+        for path in sorted(paths):
+            st = os.stat(path)
+            files[path] = [st.st_size, st.st_mtime_ns]
+        return files
+
+    def _scan_assets(self):
+        """
+        Reads the digit clips and alignments and returns what the manifest holds: the format and length
+        of each digit clip, the safe zones of each aligned chapter (sorted by duration) and the clip statistics.
+        """
+        numbers = {}
+        for path in sorted(glob.glob("audio/numbers/*.wav")):
+            if os.path.basename(path)[0] in "0123456789":
+                seg = self._pcm(path)
+                numbers[path] = {"ms": len(seg), "frame_rate": seg.frame_rate, "channels": seg.channels, "sample_width": seg.sample_width}
+        number_words = {"zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine"}
+        sources = []
+        for json_path in sorted(glob.glob("audio/aligned/*.json")):
+            audio_path = self._chapter_audio(json_path)
+            if audio_path is None:
+                continue
+            with open(json_path, 'r') as f:
+                data = json.load(f)
+            safe_zones = [
+                {"start": w["start"], "end": w["end"]} for w in data.get("words", [])
+                if w.get("case") == "success" and w["word"].lower() not in number_words
+            ]
+            if safe_zones:
+                # sorted by duration, so the zones longer than a slice are a bisect away
+                safe_zones.sort(key=lambda w: w["end"] - w["start"])
+                sources.append({"audio": audio_path, "zones": safe_zones})
+        durs = [clip["ms"] for clip in numbers.values()]
+        stats = {
+            "max_num_len": max(durs) if durs else 700,
+            "min_num_len": min(durs) if durs else 500,
+            "sdur": sum(durs) / len(durs) if durs else 500,
+        }
+        return {"version": MANIFEST_VERSION, "files": self._asset_files(), "numbers": numbers, "sources": sources, "stats": stats}
+
+    def _load_manifest(self):
+        """
+        Returns the manifest if it was built from the audio files as they are now (same names, sizes
+        and modification times), otherwise None. This stats every file but reads none of them.
+        """
+        try:
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Warning: could not read {self.manifest_path}:", e)
+            return None
+        if manifest.get("version") != MANIFEST_VERSION or manifest.get("files") != self._asset_files():
+            print(f"Warning: {self.manifest_path} is out of date, run python audiogen.py manifest to rebuild it.")
+            return None
+        return manifest
+
+    def write_manifest(self):
+        tmp = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, separators=(",", ":"))
+        os.replace(tmp, self.manifest_path)
+
+    def _cache_key(self, path):
+        st = os.stat(path)
+        return hashlib.sha1(f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()
+
+    def _pcm(self, path):
+        seg = self.pcm.get(path)
+        if seg is None:
+            # two threads may both load it on first use, they get the same data
+            seg = self.pcm.setdefault(path, self._load_pcm(path))
+        return seg
+
+    def _fitted(self, path):
+        seg = self.fitted.get(path)
+        if seg is None:
+            seg = self.fitted.setdefault(path, self._load_fitted(path))
+        return seg
+
+    def _fit_key(self, path):
+        return hashlib.sha1(f"{self.manifest_hash}:{path}".encode()).hexdigest()
+
+    def _load_fitted(self, path):
+        """
+        Returns digit clip path fitted to the grid. Fitting has no randomness, so the result is cached
+        in cache_dir under the manifest hash and the next process (or start) only reads it back.
+        """
+        clip = self.manifest["numbers"][path]
+        if clip["ms"] == 0:
+            return AudioSegment.silent(duration=0)
+        fit_path = os.path.join(self.cache_dir, self._fit_key(path) + ".fit")
+        try:
+            with open(fit_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            fitted = self._fit_to_grid(self._pcm(path))
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = f"{fit_path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(fitted.raw_data)
+            os.replace(tmp, fit_path)
+            return fitted
+        return AudioSegment(data=data, sample_width=clip["sample_width"], frame_rate=44100, channels=clip["channels"])
+
+    def _load_pcm(self, path):
+        """
+        Returns the decoded audio of path as an AudioSegment backed by a memory-mapped raw PCM file.
+        The file is decoded only when its cache entry (keyed by path, size and mtime) is missing.
+        """
+        key = self._cache_key(path)
+        pcm_path = os.path.join(self.cache_dir, key + ".pcm")
+        meta_path = os.path.join(self.cache_dir, key + ".json")
+        if not os.path.exists(meta_path):
+            seg = AudioSegment.from_file(path)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = f"{pcm_path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(seg.raw_data)
+            os.replace(tmp, pcm_path)
+            # the meta file is written last, so its presence means the pcm file is complete
+            tmp = f"{meta_path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump({"source": path, "sample_width": seg.sample_width, "frame_rate": seg.frame_rate, "channels": seg.channels}, f)
+            os.replace(tmp, meta_path)
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        data = b""
+        if os.path.getsize(pcm_path) > 0:
+            with open(pcm_path, "rb") as f:
+                data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return AudioSegment(data=data, sample_width=meta["sample_width"], frame_rate=meta["frame_rate"], channels=meta["channels"])
+
+    def _prune_cache(self):
+        # drop cache entries of sources that were edited or removed
+        if not os.path.isdir(self.cache_dir):
+            return
+        keep = {self._cache_key(path) for path in self.manifest["numbers"]}
+        keep.update(self._cache_key(source["audio"]) for source in self.manifest["sources"])
+        keep.update(self._fit_key(path) for path in self.manifest["numbers"])
+        for name in os.listdir(self.cache_dir):
+            if name.split(".")[0] not in keep:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
         
-    def _index_nums(self):
-        index = {str(i): [] for i in range(10)}
-        for f in glob.glob("audio/numbers/*.wav"):
-            filename = os.path.basename(f)
-            digit = filename[0]
-            if digit in index:
-                index[digit].append(f)
-        return index
     def _fit_to_grid(self,segment):
         #grid is a 1D grid
         currentlen=len(segment)
         if currentlen==0:return AudioSegment.silent(duration=0)
-        new_rate = int((currentlen / self.sdur) * segment.frame_rate)
-        new_rate = max(8000, min(new_rate, 96000))
-        warped = segment._spawn(segment.raw_data, overrides={"frame_rate": new_rate})
-        return warped.set_frame_rate(44100).normalize()
-    def generate_real(self,digits):
-        combined= AudioSegment.empty()
-        spacer= AudioSegment.silent(duration=self.gap)
+        with stage_seconds.time("fit_to_grid"):
+            new_rate = int((currentlen / self.sdur) * segment.frame_rate)
+            new_rate = max(8000, min(new_rate, 96000))
+            warped = segment._spawn(segment.raw_data, overrides={"frame_rate": new_rate})
+            fitted = warped.set_frame_rate(44100).normalize()
+            if isinstance(fitted.raw_data, memoryview):
+                # still a view into the pcm cache (nothing was resampled), pydub can only concatenate bytes
+                fitted = fitted._spawn(bytes(fitted.raw_data))
+        return fitted
+    def _gap(self, frame_rate, channels, sample_width):
+        # the gap as it ends up after pydub converts AudioSegment.silent to the snippets' format, always zeros
+        key = (frame_rate, channels, sample_width)
+        gap = self._gaps.get(key)
+        if gap is None:
+            silence = AudioSegment.silent(duration=self.gap).set_channels(channels).set_frame_rate(frame_rate).set_sample_width(sample_width)
+            gap = self._gaps[key] = bytes(len(silence.raw_data))
+        return gap
+    def _assemble(self, snippets):
+        """
+        Returns the snippets with a gap after each, the same samples as summing them up with +,
+        but joined into one buffer of the final length instead of copying the frame on every +.
+        """
+        if not snippets:
+            return AudioSegment.empty()
+        first = snippets[0]
+        fmt = (first.frame_rate, first.channels, first.sample_width)
+        if first.frame_rate < 11025 or first.sample_width < 2 or any((s.frame_rate, s.channels, s.sample_width) != fmt for s in snippets):
+            # pydub would convert the frame between formats while summing, leave that to it
+            combined = AudioSegment.empty()
+            spacer = AudioSegment.silent(duration=self.gap)
+            for snippet in snippets:
+                combined += snippet + spacer
+            return combined
+        gap = self._gap(*fmt)
+        parts = []
+        for snippet in snippets:
+            parts.append(snippet.raw_data)
+            parts.append(gap)
+        return first._spawn(b"".join(parts))
+    def generate_real(self,digits,rng=None):
+        """
+        rng (a random.Random) picks the clips instead of secrets, so the same seed gives the same frame.
+        """
+        choice = rng.choice if rng is not None else secrets.choice
+        snippets = []
         for i in str(digits):
             if i not in self.num_files or not self.num_files[i]:
                 continue
-            path=secrets.choice(self.num_files[i])
-            seg = AudioSegment.from_wav(path)
-            combined += self._fit_to_grid(seg) + spacer
-        return combined
-    def generate_decoy(self, length):
-        combined = AudioSegment.empty()
-        spacer = AudioSegment.silent(duration=self.gap)
-        source_data = secrets.choice(self.decoy_sources)
-        full_audio = AudioSegment.from_mp3(source_data["audio"])
+            path=choice(self.num_files[i])
+            snippets.append(self._fitted(path))
+        return self._assemble(snippets)
+    def _make_snippet(self, i, rng=None):
+        """
+        Slices a random syllable sized piece out of a safe zone of decoy source i and fits it to the grid.
+        """
+        source_data = self.decoy_sources[i]
+        full_audio = self._pcm(source_data["audio"])
         safe_zones = source_data["zones"]
-        cryptogen = secrets.SystemRandom()
-        for _ in range(length):
-            slice_len = cryptogen.randint(int(self.min_num_len), int(self.max_num_len))
-            candidates = [w for w in safe_zones if (w["end"] - w["start"]) * 1000 > slice_len]
-            if not candidates:
-                word = cryptogen.choice(safe_zones)
-                print("Warning: not candidates is true")
-            else:
-                word = cryptogen.choice(candidates)
-            w_start_ms = int(word["start"] * 1000)
-            w_end_ms = int(word["end"] * 1000)
-            w_dur = w_end_ms - w_start_ms
-            if w_dur > slice_len:
-                max_offset = w_dur - slice_len
-                offset = cryptogen.randint(0, max_offset)
-                start = w_start_ms + offset
-                end = start + slice_len
-            else:
-                start, end = w_start_ms, w_end_ms
-            
+        cryptogen = rng if rng is not None else secrets.SystemRandom()
+        slice_len = cryptogen.randint(int(self.min_num_len), int(self.max_num_len))
+        first = bisect_right(source_data["durs"], slice_len)
+        if first == len(safe_zones):
+            word = cryptogen.choice(safe_zones)
+            print("Warning: not candidates is true")
+        else:
+            word = safe_zones[cryptogen.randrange(first, len(safe_zones))]
+        w_start_ms = int(word["start"] * 1000)
+        w_end_ms = int(word["end"] * 1000)
+        w_dur = w_end_ms - w_start_ms
+        if w_dur > slice_len:
+            max_offset = w_dur - slice_len
+            offset = cryptogen.randint(0, max_offset)
+            start = w_start_ms + offset
+            end = start + slice_len
+        else:
+            start, end = w_start_ms, w_end_ms
+
+        with stage_seconds.time("audio_slice"):
             seg = full_audio[start:end]
-            combined += self._fit_to_grid(seg) + spacer
-            
-        return combined
+        return self._fit_to_grid(seg)
+    def generate_decoy(self, length, rng=None):
+        """
+        Without rng the snippets come from the bank. With rng they are cut here from that generator,
+        so the same seed gives the same frame.
+        """
+        if rng is not None:
+            i = rng.randrange(len(self.decoy_sources))
+            return self._assemble([self._make_snippet(i, rng) for _ in range(length)])
+        return self._assemble(self._take_snippets(secrets.randbelow(len(self.decoy_sources)), length))
     def segment_to_base64(self, segment):
         buffer = io.BytesIO()
         segment.export(buffer, format="mp3", bitrate="64k")
@@ -104,4 +558,19 @@ class AudioGenerator:
         base64_data = base64.b64encode(binary_data).decode('utf-8')
         return base64_data
 
-        
\ No newline at end of file
+    def segments_to_mp3(self, segments):
+        return self._mp3.encode(segments)
+
+
+        
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build audio/manifest.json, so the server starts without reading every clip and alignment.")
+    parser.add_argument("command", choices=["manifest"])
+    parser.add_argument("--config", default="config.json")
+    args = parser.parse_args()
+    generator = AudioGenerator(args.config, use_manifest=False)
+    generator.write_manifest()
+    print(f"Wrote {generator.manifest_path}: {len(generator.manifest['numbers'])} digit clips, {len(generator.decoy_sources)} decoy sources.")
@@ -1,23 +1,65 @@
 #!/usr/bin/env python3
-from collections import defaultdict
+import time
+load_started=time.monotonic()
 import io
 import zlib
 import base64
 import json
 import sys
+import string
 from PIL import Image, ImageDraw, ImageFont
-import pyfiglet
-from fastapi import FastAPI
-from fastapi.responses import PlainTextResponse
+from figcache import asciiart, preload
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, Response, JSONResponse
 import uvicorn
 import secrets
 from pydub import AudioSegment
 import jwt
 from fastapi.middleware.cors import CORSMiddleware
 import importlib
-import time
+import importlib.util
+import hmac
+import hashlib
+import random
 import shutil
-app = FastAPI()
+import socket
+import select
+import signal
+import gc
+import threading
+import os
+import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from challengepool import ChallengePool, BuildLimiter, Overloaded
+from challengestore import create_store
+from compiledchain import CompiledMarkovChain, compile_json
+import wireformat
+from tokencache import VerifiedTokenCache
+from framecache import FrameCache
+import metrics
+from metrics import stage_seconds
+
+@asynccontextmanager
+async def lifespan(app):
+    global build_executor
+    if process_workers>0:
+        build_executor=new_build_executor()
+    challenge_pool.start()
+    loop=asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGHUP,lambda: loop.run_in_executor(None,reload_from_signal))
+    except (AttributeError,NotImplementedError,RuntimeError):
+        pass # no SIGHUP on Windows, and only the main thread can handle signals
+    yield
+    challenge_pool.stop()
+    if build_executor is not None:
+        build_executor.shutdown(cancel_futures=True)
+        build_executor=None
+app = FastAPI(lifespan=lifespan)
 origins = [
     "http://localhost",
     "http://localhost:8080",
@@ -28,181 +70,324 @@ color_err="\x1b[1;91;49m"
 color_acc="\x1b[1;92;49m"
 color_reset="\x1b[0m"
 class CaptchaCompressor:
-    def __init__(self, font_path="font.ttf", font_size=20):
+    # zlib levels used by level="auto", indexed by how many bundles are being compressed at once.
+    # 9 costs ~10x the CPU of 6 for ~10% fewer bytes, so it is only used while the server is idle.
+    auto_levels = (9, 7, 6, 4, 1)
+
+    def __init__(self, font_path="font.ttf", font_size=20, atlas_chars=string.printable[:95], level=9):
+        self.level = level
+        self._active = 0
+        self._stats_lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            # another thread may hold the lock while a build process is forked
+            os.register_at_fork(after_in_child=self._after_fork)
+        self.stats = {} # level -> [bundles, raw bytes, compressed bytes, seconds]
         try:
             self.font = ImageFont.truetype(font_path, font_size)
         except:
             print("Warning: Font not found, loading default.")
             self.font = ImageFont.load_default()
+        self.atlas = self._build_atlas(atlas_chars)
+
+    def _after_fork(self):
+        self._stats_lock = threading.Lock()
+        self._active = 0
+
+    def _build_atlas(self, atlas_chars):
+        """
+        Renders every char once into a monospace glyph atlas.
+        Returns None (so frames fall back to draw.text) if the font is not fixed pitch.
+        """
+        advances = {self.font.getlength(c) for c in atlas_chars}
+        if len(advances) != 1:
+            print("Warning: Font is not monospace, glyph atlas disabled.")
+            return None
+        advance = advances.pop()
+        if advance != int(advance):
+            print("Warning: Font advance is fractional, glyph atlas disabled.")
+            return None
+        d = ImageDraw.Draw(Image.new('1', (1, 1)))
+        line_step = d.textbbox((0, 0), "A\nA", font=self.font)[3] - d.textbbox((0, 0), "A", font=self.font)[3]
+        glyphs = {}
+        for c in atlas_chars:
+            bbox = d.textbbox((0, 0), c, font=self.font)
+            if bbox[2] <= bbox[0] or bbox[3] <= bbox[1]:
+                continue # blank glyph (space), nothing to blit
+            pad = int(advance) * 2
+            cell = Image.new('1', (bbox[2] + pad * 2, bbox[3] + pad * 2), color=0)
+            draw = ImageDraw.Draw(cell)
+            draw.text((pad, pad), c, font=self.font, fill=1)
+            ink = cell.getbbox()
+            if ink is None:
+                continue
+            glyphs[c] = (cell.crop(ink), ink[0] - pad, ink[1] - pad)
+        return {"advance": int(advance), "line_step": line_step, "glyphs": glyphs, "chars": set(atlas_chars) | {"\n"}}
+
+    def _render_frame(self, text, width, height):
+        """
+        Returns an 'L' image of the frame where ink is 255 and background is 0.
+        """
+        img = Image.new('L', (width, height), color=0)
+        atlas = self.atlas
+        if atlas is None or not atlas["chars"].issuperset(text):
+            ImageDraw.Draw(img).text((5, 5), text, font=self.font, fill=255)
+            return img
+        glyphs = atlas["glyphs"]
+        advance = atlas["advance"]
+        y = 5
+        for line in text.split("\n"):
+            x = 5
+            for c in line:
+                glyph = glyphs.get(c)
+                if glyph is not None:
+                    mask, dx, dy = glyph
+                    img.paste(255, (x + dx, y + dy), mask) # paste with a mask ORs the ink in
+                x += advance
+            y += atlas["line_step"]
+        return img
 
     def encode_bundle(self, text_frames):
         """
         Takes a list of ASCII strings.
         Returns a JSON object with metadata and ONE compressed binary blob.
         """
+        bundle = self.pack_bundle(text_frames)
+        if bundle is None: return None
+        bundle["data"] = base64.b64encode(bundle["data"]).decode('utf-8')
+        return bundle
+
+    def pack_bundle(self, text_frames, level=None):
+        """
+        Same as encode_bundle but "data" is the raw compressed bytes, for the binary transport.
+        level overrides the zlib level (see reserve_level), by default it follows self.level.
+        """
         if not text_frames: return None
 
         dummy_img = Image.new('1', (1, 1))
         d = ImageDraw.Draw(dummy_img)
         bbox = d.textbbox((0, 0), text_frames[0], font=self.font)
         width, height = bbox[2], bbox[3]
-        
+
         width += 10
         height += 10
         all_frames_bits = bytearray()
 
         print(f"Encoding {len(text_frames)} frames...")
 
-        for text in text_frames:
-            img = Image.new('1', (width, height), color=1) # 1 is white
-            draw = ImageDraw.Draw(img)
-            draw.text((5, 5), text, font=self.font, fill=0) # 0 is black
-            pixels = list(img.getdata())
-            frame_bytes = bytearray()
-            current_byte = 0
-            bit_idx = 0
-            
-            for p in pixels:
-                if p == 0: 
-                    current_byte |= (1 << (7 - bit_idx))
-                bit_idx += 1
-                if bit_idx == 8:
-                    frame_bytes.append(current_byte)
-                    current_byte = 0
-                    bit_idx = 0
-            if bit_idx > 0:
-                frame_bytes.append(current_byte)
-                
-            all_frames_bits.extend(frame_bytes)
-        compressed_data = zlib.compress(all_frames_bits, level=9)
-        b64_string = base64.b64encode(compressed_data).decode('utf-8')
+        with stage_seconds.time("rasterize"):
+            for text in text_frames:
+                img = self._render_frame(text, width, height)
+                # frames are packed as one continuous bitstream (no per-row padding),
+                # so pack it as a single row: ink (255) becomes a 1 bit, MSB first
+                row = Image.frombytes('L', (width * height, 1), img.tobytes())
+                all_frames_bits.extend(row.convert('1', dither=Image.Dither.NONE).tobytes())
+        compressed_data = self._compress(all_frames_bits, level)
 
         return {
             "width": width,
             "height": height,
             "count": len(text_frames),
-            "data": b64_string
+            "data": compressed_data
         }
-imager = CaptchaCompressor()
-class AsciiMarkovChain:
-    def __init__(self, corpus=None, order=5):
-        self.order = order
-        self.model = defaultdict(list)
-        if corpus:
-            self._train(corpus)
-    def _train(self, corpus):
-        for i in range(len(corpus) - self.order):
-            current_state = corpus[i : i + self.order]
-            next_char = corpus[i + self.order]
-            self.model[current_state].append(next_char)
-
-    def generate(self, length=1000):
-        # produce exactly `length` characters in the returned string
-        if length <= 0:
-            return ""
-        start_key = secrets.choice(list(self.model.keys()))
-        output = start_key
-        current_state = start_key
-
-        # keep adding characters until we have at least `length`, then trim
-        while len(output) < length:
-            possible_next_chars = self.model.get(current_state)
-            if not possible_next_chars:
-                current_state = secrets.choice(list(self.model.keys()))
-                # reset current_state to a valid key but keep trying to reach desired length
-                continue
+    def _level_for(self, active):
+        if self.level == "auto":
+            return self.auto_levels[min(active, len(self.auto_levels)) - 1]
+        return self.level
 
-            next_char = secrets.choice(possible_next_chars)
-            output += next_char
-            current_state = output[-self.order:]
+    @contextmanager
+    def reserve_level(self):
+        """
+        For a bundle compressed in a build process: picks its level from how many bundles this
+        process has in flight (a build process only ever sees its own one) and counts it as in flight
+        until the block ends.
+        """
+        with self._stats_lock:
+            self._active += 1
+            level = self._level_for(self._active)
+        try:
+            yield level
+        finally:
+            with self._stats_lock:
+                self._active -= 1
 
-        return output[:length]
+    def _compress(self, data, level=None):
+        with self._stats_lock:
+            self._active += 1
+            if level is None:
+                level = self._level_for(self._active)
+        started = time.perf_counter()
+        try:
+            compressed = zlib.compress(data, level=level)
+        finally:
+            elapsed = time.perf_counter() - started
+            stage_seconds.observe(elapsed, "zlib")
+            with self._stats_lock:
+                self._active -= 1
+        with self._stats_lock:
+            stats = self.stats.setdefault(level, [0, 0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += len(data)
+            stats[2] += len(compressed)
+            stats[3] += elapsed
+        return compressed
 
-    def save_to_json(self, filepath="model.json"):
-        data = {
-            "order": self.order,
-            "model": self.model
-        }
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False)
-        print(f"Model saved to {filepath}")
-    @classmethod
-    def load_from_json(cls, filepath="model.json"):
-        with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        instance = cls(corpus=None, order=data["order"])
-        instance.model = defaultdict(list, data["model"])
-        
-        return instance
-    
+    def merge_stats(self, stats):
+        """
+        Adds stats collected by another process (see _build_in_process) to this one.
+        """
+        with self._stats_lock:
+            for level, (bundles, raw, compressed, seconds) in stats.items():
+                own = self.stats.setdefault(level, [0, 0, 0, 0.0])
+                own[0] += bundles
+                own[1] += raw
+                own[2] += compressed
+                own[3] += seconds
 
-def asciiart(text_font_pairs):
-    all_blocks = []
-    for text, font in text_font_pairs:
-        art = pyfiglet.figlet_format(text, font=font)
-        all_blocks.append(art.splitlines())
-    max_height = max(len(block) for block in all_blocks)
-    for block in all_blocks:
-        while len(block) < max_height:
-            block.append(" " * len(block[0]) if block else "")
-    ans = ""
-    for i in range(max_height):
-        combined_line = "".join(block[i] for block in all_blocks)
-        ans += combined_line + "\n"
-    return ans
+    def report(self):
+        """
+        Returns the achieved compression ratio (compressed / raw) and time, per zlib level.
+        """
+        with self._stats_lock:
+            stats = {level: list(s) for level, s in self.stats.items()}
+        raw = sum(s[1] for s in stats.values())
+        compressed = sum(s[2] for s in stats.values())
+        return {
+            "level": self.level,
+            "bundles": sum(s[0] for s in stats.values()),
+            "ratio": round(compressed / raw, 4) if raw else None,
+            "by_level": {
+                str(level): {"bundles": s[0], "ratio": round(s[2] / s[1], 4) if s[1] else None, "avg_ms": round(1000 * s[3] / s[0], 2)}
+                for level, s in sorted(stats.items())
+            },
+        }
+imager = CaptchaCompressor()
+class ConfigError(Exception):
+    """
+    config.json or a model can't be loaded. The message is meant for the console.
+    """
 
-try:
-    with open("config.json","r") as f:
-        config=json.load(f)
-        good_fonts=config["good_fonts"]
-        chars=config["chars"] #Confusing chars may make the captcha hard so those are removed
-        charlens=config["charlens"]
-        steps=config.get("steps",50)
-        deceptor=config.get("deceptor","markov")
-        if deceptor=="markov":
-            markov_chain=AsciiMarkovChain.load_from_json("model.json")
-            def generate_decoy(linelen,lineheight,realtext):
-                global markov_chain
-
-                decoy_base=markov_chain.generate(linelen*(lineheight-1)+1)
+def load_deceptor(deceptor, reload_module=False):
+    """
+    Returns (generate_decoy, generate_decoys) for the deceptor named in config.json.
+    reload_module loads a custom deceptor module again as a new module object, so it loads its model files again
+    and the module the current settings use is left as it is.
+    """
+    if deceptor=="markov":
+        # model.bin is the compiled form of model.json, rebuilt whenever model.json is newer
+        if os.path.exists("model.json") and (not os.path.exists("model.bin") or os.path.getmtime("model.bin") < os.path.getmtime("model.json")):
+            print("Compiling model.json to model.bin...")
+            compile_json("model.json","model.bin")
+        markov_chain=CompiledMarkovChain("model.bin")
+        def generate_decoy(linelen,lineheight,realtext):
+            decoy_base=markov_chain.generate(linelen*(lineheight-1)+1)
+            decoy=decoy_base[:-1]
+            #split into lineheight lines of length linelen
+            lines=[]
+            for i in range(lineheight-1):
+                lines.append(decoy[i*linelen:(i+1)*linelen])
+            return "\n".join(lines) + decoy_base[-1]
+        def generate_decoys(linelen,lineheight,realtext,count):
+            decoys=[]
+            for decoy_base in markov_chain.generate_many(linelen*(lineheight-1)+1,count):
                 decoy=decoy_base[:-1]
-                #split into lineheight lines of length linelen
-                lines=[]
-                for i in range(lineheight-1):
-                    lines.append(decoy[i*linelen:(i+1)*linelen])
-                return "\n".join(lines) + decoy_base[-1]
-        elif deceptor=="random":
-            def generate_decoy(linelen,lineheight,realtext):
-                decoy=""
-                charset=realtext.replace("\n","")
-                for _ in range(lineheight):
-                    line="".join(secrets.choice(charset) for _ in range(linelen))
-                    decoy+=line+"\n"
-                return decoy
-        else:
-            #import python module
-            try:
+                lines=[decoy[i*linelen:(i+1)*linelen] for i in range(lineheight-1)]
+                decoys.append("\n".join(lines) + decoy_base[-1])
+            return decoys
+    elif deceptor=="random":
+        def generate_decoy(linelen,lineheight,realtext):
+            decoy=""
+            charset=realtext.replace("\n","")
+            for _ in range(lineheight):
+                line="".join(secrets.choice(charset) for _ in range(linelen))
+                decoy+=line+"\n"
+            return decoy
+        def generate_decoys(linelen,lineheight,realtext,count):
+            charset=realtext.replace("\n","")
+            cells=linelen*lineheight
+            # one os.urandom call for every cell of every decoy instead of a secrets.choice per cell,
+            # x%len(charset) is biased by at most len(charset)/2**64
+            rand=memoryview(os.urandom(8*max(1,cells*count))).cast("Q")
+            decoys=[]
+            for k in range(count):
+                chars="".join([charset[x%len(charset)] for x in rand[k*cells:(k+1)*cells]])
+                decoys.append("".join(chars[i*linelen:(i+1)*linelen]+"\n" for i in range(lineheight)))
+            return decoys
+    else:
+        #import python module
+        try:
+            if reload_module:
+                # a new module object, importlib.reload would change the module the settings in use call into
+                spec=importlib.util.find_spec(deceptor)
+                if spec is None:
+                    raise ImportError(f"No module named {deceptor!r}")
+                deceptor_module=importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(deceptor_module)
+            else:
                 deceptor_module=importlib.import_module(deceptor)
-            except ImportError as e:
-                print(f"{color_err}Error: Deceptor module not found.{color_reset}",e)
-                exit(1)
-            def generate_decoy(linelen,lineheight,realtext):
-                return deceptor_module.generate_decoy(linelen,lineheight,realtext)
+        except ImportError as e:
+            raise ConfigError(f"Deceptor module not found. {e}") from e
+        def generate_decoy(linelen,lineheight,realtext):
+            return deceptor_module.generate_decoy(linelen,lineheight,realtext)
+        if hasattr(deceptor_module,"generate_decoys"):
+            generate_decoys=deceptor_module.generate_decoys
+        else:
+            def generate_decoys(linelen,lineheight,realtext,count):
+                return [deceptor_module.generate_decoy(linelen,lineheight,realtext) for _ in range(count)]
+    return generate_decoy,generate_decoys
+
+class Settings:
+    """
+    Everything that comes from config.json and the model files. A reload builds a new Settings and
+    replaces the module level `settings` in one assignment, so every challenge is built from one version.
+    """
+    def __init__(self, path="config.json", version=1, reload_modules=False):
+        try:
+            with open(path,"r") as f:
+                config=json.load(f)
+        except FileNotFoundError as e:
+            raise ConfigError(f"{path} not found.") from e
+        except json.JSONDecodeError as e:
+            raise ConfigError(f"{path} is not valid JSON. {e}") from e
+        self.version=version
+        self.config=config
+        try:
+            self.good_fonts=config["good_fonts"]
+            self.chars=config["chars"] #Confusing chars may make the captcha hard so those are removed
+            self.charlens=config["charlens"]
+        except KeyError as e:
+            raise ConfigError(f"{e} not set in {path}.") from e
+        preload(self.good_fonts,self.chars)
+        self.steps=config.get("steps",50)
+        self.zlib_level=config.get("zlib_level",9)
+        if self.zlib_level!="auto" and not (isinstance(self.zlib_level,int) and 0<=self.zlib_level<=9):
+            print(f"{color_warn}Warning: zlib_level must be 0-9 or \"auto\", using 9.{color_reset}")
+            self.zlib_level=9
+        self.deceptor=config.get("deceptor","markov")
+        self.generate_decoy,self.generate_decoys=load_deceptor(self.deceptor,reload_modules)
         audio_engine=config.get("audio_engine","audiogen")
         try:
             audio_module=importlib.import_module(audio_engine)
-            audio_generator=audio_module.AudioGenerator("config.json")
         except ImportError as e:
-            print(f"{color_err}Error: Audio engine module not found.{color_reset}",e)
-            exit(1)
-        jwt_secret=config.get("jwt_secret",None)
-        if jwt_secret == None:
-            print(f"{color_err}Error: jwt_secret not set in config.json. Please set it to a secure random string.{color_reset}")
-            exit(1)
-except FileNotFoundError:
-    print(f"{color_err}Error: config.json not found.{color_reset}")
-    print(f"{color_warn}Try copying config.json.example to config.json and editing it as needed.{color_reset}")
+            raise ConfigError(f"Audio engine module not found. {e}") from e
+        try:
+            self.audio_generator=audio_module.AudioGenerator(path)
+        except ValueError as e:
+            raise ConfigError(str(e)) from e
+        self.jwt_secret=config.get("jwt_secret",None)
+        if self.jwt_secret == None:
+            raise ConfigError(f"jwt_secret not set in {path}. Please set it to a secure random string.")
+        self.frame_seed_key=hmac.new(self.jwt_secret.encode(),b"tinac audio frame seed",hashlib.sha256).digest()
+
+try:
+    settings=Settings("config.json")
+except ConfigError as e:
+    print(f"{color_err}Error: {e}{color_reset}")
+    if not os.path.exists("config.json"):
+        print(f"{color_warn}Try copying config.json.example to config.json and editing it as needed.{color_reset}")
     exit(1)
+# pools, workers, the challenge store and caches are set up once from the config at startup, a reload doesn't change them
+config=settings.config
+imager.level=settings.zlib_level
 
 app.add_middleware(
     CORSMiddleware,
@@ -213,12 +398,21 @@ app.add_middleware(
 )
 print(color_acc+asciiart([("Starting...", "standard")])+color_reset)
 print(f"{color_acc}TINAC API is running. Press Ctrl+C to stop.{color_reset}")
-print(f"{color_acc}Listening on 0.0.0.0:{sys.argv[1] if len(sys.argv) > 1 else 3456}.{color_reset}")
-if ((shutil.which("ffmpeg") is None) and (shutil.which("avconv") is None)) and ("audio" in config.get("allowed_types",[])):
+def cli_port():
+    args=sys.argv[1:]
+    if args[:1]==["serve"]:
+        return int(args[args.index("--port")+1]) if "--port" in args else 3456
+    return int(args[0]) if args and args[0].isdigit() else 3456
+print(f"{color_acc}Listening on 0.0.0.0:{cli_port()}.{color_reset}")
+if ((shutil.which("ffmpeg") is None) and (shutil.which("avconv") is None)) and ("audio" in config.get("allowed_types",[])) and getattr(getattr(settings.audio_generator,"encoder",None),"needs_ffmpeg",True):
     print(f"{color_warn}Warning: ffmpeg or avconv not installed. Audio challenges may not work properly.{color_reset}")
-if jwt_secret=="CHANGE_THIS_CHANGE_THIS_CHANGE_THIS_CHANGE_THIS":
+if settings.jwt_secret=="CHANGE_THIS_CHANGE_THIS_CHANGE_THIS_CHANGE_THIS":
             print(f"{color_err}Warning: jwt_secret is set to the default value. THIS IS ONLY RECOMMENDED FOR TESTING. Change this to a different value.{color_reset}")
-challenges={}
+try:
+    challenges=create_store(config)
+except ImportError as e:
+    print(f"{color_err}Error: Challenge store module not found.{color_reset}",e)
+    exit(1)
 @app.get("/",response_class=PlainTextResponse)
 def read_root():
     """
@@ -239,128 +433,469 @@ GET /challenge_img: Get an image challenge.The image is a compressed bundle of a
         "challenge":{"width":W,"height":H,"count":N,"data":"base64-encoded-compressed-binary-blob"},
         "steps":50}
     Use the same /verify endpoint to verify the answer.
+    Send "Accept: application/octet-stream" to get the bundle as raw bytes instead of JSON. See wireformat.py for the format.
     To decode the image, see the example.html implementation in github.com/itzmetanjim/tinac
-GET /challenge_audio: Get an audio challenge.The audio is a base64 encoded mp3 file array.
+GET /challenge_audio: Get an audio challenge.The audio is a base64 encoded array of audio files, mp3 unless audio_format says otherwise.
     Request body: none needed
     Example response:
         {"id":"unique-id-urlsafe-base64",
         "challenge":["base64-encoded-mp3-audio-data1","2", ... ,"50"],
-        "steps":50}
+        "steps":50,
+        "media_type":"audio/mpeg"}
     Use the same /verify endpoint to verify the answer.
+    Send "Accept: application/octet-stream" to get the mp3 files as raw bytes instead of JSON. See wireformat.py for the format.
+    With "audio_lazy" in config.json the response has no "challenge", only {"id":...,"steps":50,"lazy":true},
+    and each frame is fetched on its own:
+GET /challenge_audio/{id}/{index}: One frame (0 to steps-1) of a lazy audio challenge, as media_type. 404 if the id is invalid or answered,
+    410 if it was issued before a settings reload.
 POST /verify    : Verify an answer (case sensitive).
     Example request body: {"id":"unique-id-urlsafe-base64","answer":"abcd"} or {"id":"unique-id-urlsafe-base64","answer":"abcd", "index": 2}
     Example response: {"answer": true} 
                 or: {"answer": true, "index": true}
                 or: {"error": "Invalid or expired ID/id parameter required/answer parameter required"}
+POST /verify_token: Check a token returned by /verify.
+    Example request body: {"token":"jwt-token"} or {"token":"jwt-token","expected_type":"image"}
+    Example response: {"valid": true, "data": {"cid": "...", "answer": true, "index": true, "type": "image", "iat": 1700000000, "exp": 1700000300}}
+                or: {"valid": false, "error": "Token has expired/Invalid token/Token is for a different captcha type"}
+POST /verify_tokens: Check many tokens at once (at most max_token_batch).
+    Example request body: {"tokens":["jwt-token1","jwt-token2"],"expected_type":"image"}
+    Example response: {"results": [{"valid": true, "data": {...}}, {"valid": false, "error": "Token has expired"}]}
+POST /admin/reload: Reload config.json and the models without a restart (kill -HUP does the same).
+    Needs the header "Authorization: Bearer <admin_token>", and admin_token set in config.json.
+    Example response: {"version": 2} or {"error": "Reload failed, still serving version 1: ..."}
+    Challenges carry the version they were made with in "version" and the X-TINAC-Version header.
+GET /metrics    : Prometheus metrics. tinac_stage_seconds has a histogram per stage (figlet, decoys, rasterize, zlib, base64,
+    audio_slice, fit_to_grid, mp3 (or wav/ulaw), jwt_sign, jwt_verify). There are also gauges for the challenge store and pools,
+    and counters for issued challenges, 503s, /verify outcomes and token checks.
+GET /token_cache: Get the size and hit/miss counts of the cache of already verified tokens.
+GET /pool       : Get the state of the pre-generated challenge pools.
+    Example response: {"image": {"depth": 16, "watermark": 16, "hits": 120, "misses": 3, "generated": 136, "avg_build_ms": 85.1, "refill_per_sec": 1.2,
+                                 "build_queue": {"pending": 0, "limit": 18, "rejected": 0, "avg_build_ms": 90.2}}, ...}
+The /challenge endpoints return HTTP 503 with a Retry-After header when too many requests are already waiting for a challenge to be built.
+GET /compression: Get the compression ratio of image bundles (compressed size / raw size), per zlib level.
+    Example response: {"level": "auto", "bundles": 140, "ratio": 0.0802, "by_level": {"6": {"bundles": 12, "ratio": 0.0885, "avg_ms": 4.4}, "9": {"bundles": 128, "ratio": 0.0794, "avg_ms": 51.3}}}
+GET /store      : Get the state of the challenge store.
+    Example response: {"entries": 1200, "memory_bytes": 310000, "ttl": 600, "max_entries": 1000000, "expired": 50, "evicted": 0}
     """
 
-@app.get("/challenge")
-def get_challenge():
-    if "legacy" not in config.get("allowed_types",[]):
-        return {"error":"Legacy challenges are disabled."}
-    global charlens
-    
-    cid="legacy_"+secrets.token_urlsafe(32)
-    challenge="".join(secrets.choice(chars) for _ in range(secrets.choice(charlens)))
-    fonts=[secrets.choice(good_fonts) for _ in range(len(challenge))]
-    if len(challenges)>100000000: # approx 4GB ram usage limit
-        challenges.popitem(last=False)
-    ctext = asciiart(list(zip(challenge, fonts)))
+def build_text_challenge(s=None):
+    """
+    Builds a fresh text challenge from Settings s (the current settings by default).
+    Returns (challenge, correct_index, frames, version) where frames is the list of ASCII frames
+    and version is the settings version it was built with.
+    """
+    s=s or settings
+    steps=s.steps
+    challenge="".join(secrets.choice(s.chars) for _ in range(secrets.choice(s.charlens)))
+    fonts=[secrets.choice(s.good_fonts) for _ in range(len(challenge))]
+    with stage_seconds.time("figlet"):
+        ctext = asciiart(list(zip(challenge, fonts)))
     correct_index=secrets.randbelow(steps+1)
-    challenges[cid]=[challenge,correct_index]
+    #all decoys share the shape of the real text, so measure it once
+    ctext_lines=ctext.split("\n")
+    emptylinesbefore=0
+    emptylinesafter=0
+    for line in ctext_lines:
+        if line.strip()=="":
+            emptylinesbefore+=1
+        else:
+            break
+    for line in reversed(ctext_lines):
+        if line.strip()=="":
+            emptylinesafter+=1
+        else:
+            break
+    linelen = max(len(line) for line in ctext_lines)
+    lineheight = len(ctext_lines) - emptylinesbefore - emptylinesafter
     #generate decoys
+    with stage_seconds.time("decoys"):
+        decoys=iter(s.generate_decoys(linelen,lineheight,challenge,sum(1 for i in range(steps) if i!=correct_index)))
     challenges_list=[]
     for i in range(steps):
         if i==correct_index:
             challenges_list.append(ctext)
         else:
-            emptylinesbefore=0
-            emptylinesafter=0
-            for line in ctext.split("\n"):
-                if line.strip()=="":
-                    emptylinesbefore+=1
-                else:
-                    break
-            for line in reversed(ctext.split("\n")):
-                if line.strip()=="":
-                    emptylinesafter+=1
-                else:
-                    break
-            linelen = max(len(line) for line in ctext.split("\n"))
-            lineheight = len(ctext.split("\n")) - emptylinesbefore - emptylinesafter
-            
-            decoy_text=(" "*linelen + "\n")* emptylinesbefore + generate_decoy(linelen,lineheight,challenge) + ("\n" + " "*linelen)* emptylinesafter
+            decoy_text=(" "*linelen + "\n")* emptylinesbefore + next(decoys) + ("\n" + " "*linelen)* emptylinesafter
             challenges_list.append(decoy_text)
-    
-    return {"id":cid,"challenge":challenges_list,"steps":steps}
+    return challenge,correct_index,challenges_list,s.version
 
+def build_image_challenge(s=None,level=None):
+    challenge,correct_index,challenges_list,version=build_text_challenge(s)
+    #now convert to image, base64 is only added if the client wants JSON
+    imgdata = imager.pack_bundle(challenges_list,level)
+    return challenge,correct_index,imgdata,version
 
+def encode_audio(audio_generator,segments):
+    """
+    Encodes segments with the engine's encoder (audio_format), or to mp3 for engines without one.
+    """
+    encoder=getattr(audio_generator,"encoder",None)
+    if encoder is not None:
+        with stage_seconds.time(encoder.name):
+            return encoder.encode(segments)
+    with stage_seconds.time("mp3"):
+        if hasattr(audio_generator, "segments_to_mp3"):
+            return audio_generator.segments_to_mp3(segments)
+        return [base64.b64decode(audio_generator.segment_to_base64(seg)) for seg in segments]
 
-@app.get("/challenge_img")
-def get_challenge_img():
-    if "image" not in config.get("allowed_types",[]):
-        return {"error":"Image challenges are disabled."}
-    global charlens
-    global imager #CaptchaCompressor instance
-
-    cid="image_"+secrets.token_urlsafe(32)
-    challenge="".join(secrets.choice(chars) for _ in range(secrets.choice(charlens)))
-    fonts=[secrets.choice(good_fonts) for _ in range(len(challenge))]
-    if len(challenges)>100000000: # approx 4GB ram usage limit
-        challenges.popitem(last=False)
-    ctext = asciiart(list(zip(challenge, fonts)))
-    correct_index=secrets.randbelow(steps+1)
-    challenges[cid]=[challenge,correct_index]
-    #generate decoys
-    challenges_list=[]
+def audio_media_type(audio_generator):
+    return getattr(getattr(audio_generator,"encoder",None),"media_type","audio/mpeg")
+
+def pick_audio_answer(s):
+    challenge="".join(secrets.choice(s.chars) for _ in range(secrets.choice(s.charlens)))
+    return challenge,secrets.randbelow(s.steps+1)
+
+def build_audio_challenge(s=None):
+    s=s or settings
+    steps=s.steps
+    audio_generator=s.audio_generator
+    challenge,correct_index=pick_audio_answer(s)
+    segments = []
     for i in range(steps):
-        if i==correct_index:
-            challenges_list.append(ctext)
+        if i == correct_index:
+            segments.append(audio_generator.generate_real(challenge))
         else:
-            emptylinesbefore=0
-            emptylinesafter=0
-            for line in ctext.split("\n"):
-                if line.strip()=="":
-                    emptylinesbefore+=1
-                else:
-                    break
-            for line in reversed(ctext.split("\n")):
-                if line.strip()=="":
-                    emptylinesafter+=1
-                else:
-                    break
-            linelen = max(len(line) for line in ctext.split("\n"))
-            lineheight = len(ctext.split("\n")) - emptylinesbefore - emptylinesafter
-            
-            decoy_text=(" "*linelen + "\n")* emptylinesbefore + generate_decoy(linelen,lineheight,challenge) + ("\n" + " "*linelen)* emptylinesafter
-            challenges_list.append(decoy_text)
-    #now convert to image
-    imgdata = imager.encode_bundle(challenges_list)
-    return {"id":cid,"challenge":imgdata,"steps":steps}
+            segments.append(audio_generator.generate_decoy(len(challenge)))
+    #raw audio files, base64 is only added if the client wants JSON
+    return challenge,correct_index,encode_audio(audio_generator,segments),s.version
+
+def build_audio_frames(cid,challenge,correct_index,s=None):
+    """
+    Builds and encodes all frames of a lazy audio challenge. The real frame is made from the fitted digit clips
+    and is much quicker than a decoy, so frames are never built one at a time: how long a single frame took
+    would give the answer away. The randomness of each frame comes from a seed derived from the challenge id
+    and index, so building the frames again (after they left frame_cache) gives the same audio.
+    """
+    s=s or settings
+    audio_generator=s.audio_generator
+    segments=[]
+    for index in range(s.steps):
+        rng=random.Random(hmac.new(s.frame_seed_key,f"{cid}/{index}".encode(),hashlib.sha256).digest())
+        if index==correct_index:
+            segments.append(audio_generator.generate_real(challenge,rng=rng))
+        else:
+            segments.append(audio_generator.generate_decoy(len(challenge),rng=rng))
+    return encode_audio(audio_generator,segments)
+
+challenge_builders={"legacy": build_text_challenge, "image": build_image_challenge, "audio": build_audio_challenge}
+process_workers=config.get("process_workers",0)
+if process_workers>0 and "fork" not in multiprocessing.get_all_start_methods():
+    # build processes must start as copies of this one: loaded models, fork handlers, the current settings
+    print(f"{color_err}Error: process_workers needs fork() to start build processes, which this platform doesn't have. Set it to 0.{color_reset}")
+    exit(1)
+build_executor=None # ProcessPoolExecutor, created in lifespan if process_workers > 0
+executor_lock=threading.Lock() # held while build_executor is replaced
+
+def _build_in_process(ctype,level=None):
+    """
+    Runs in a build_executor process. Returns the challenge, and the compression stats and stage timings of that build.
+    level is the zlib level the server picked for an image bundle.
+    """
+    imager.stats={}
+    stage_seconds.reset()
+    item=challenge_builders[ctype](level=level) if level is not None else challenge_builders[ctype]()
+    return item,imager.stats,stage_seconds.state()
+
+def new_build_executor():
+    # always fork, spawn and forkserver (the default on some platforms) would import this module again
+    # and load config.json as version 1
+    executor=ProcessPoolExecutor(process_workers,mp_context=multiprocessing.get_context("fork"))
+    # start the worker processes now (with no pool threads running), so they begin from the loaded models
+    executor.submit(int).result()
+    return executor
+
+def run_in_build_process(fn,*args):
+    """
+    Runs fn(*args) in build_executor and returns its result. A build process that died (killed, out of memory)
+    leaves the executor broken for good, so it is replaced with a fresh one and fn is tried once more.
+    """
+    global build_executor
+    executor=build_executor
+    try:
+        return executor.submit(fn,*args).result()
+    except BrokenProcessPool:
+        with executor_lock:
+            if build_executor is executor: # not replaced by another thread yet
+                print(f"{color_warn}Warning: a build process died, starting new build processes.{color_reset}")
+                build_executor=new_build_executor()
+                executor.shutdown(wait=False)
+            executor=build_executor
+    except RuntimeError: # after BrokenProcessPool, which is one too
+        if build_executor is executor:
+            raise
+        # a reload shut this executor down after it was picked up, use the one that replaced it
+        executor=build_executor
+    return executor.submit(fn,*args).result()
+
+def _build_frames_in_process(version,*args):
+    if settings.version!=version:
+        # this process has other settings than the challenge was issued with
+        return None,{}
+    stage_seconds.reset()
+    return build_audio_frames(*args),stage_seconds.state()
+
+def build_frames(s,*args):
+    """
+    build_audio_frames with settings s, in the process pool if there is one, otherwise in the calling thread.
+    Returns None if a reload replaced s in the meantime.
+    """
+    if build_executor is None:
+        return build_audio_frames(*args,s=s)
+    frames,stages=run_in_build_process(_build_frames_in_process,s.version,*args)
+    if frames is None and s is settings:
+        # s is new and these build processes were forked before it, wait until reload_settings has replaced them
+        with executor_lock:
+            pass
+        frames,stages=run_in_build_process(_build_frames_in_process,s.version,*args)
+    stage_seconds.merge(stages)
+    return frames
+
+def build_challenge(ctype):
+    """
+    Builds a challenge in the process pool if there is one, otherwise in the calling thread.
+    """
+    if build_executor is None:
+        return challenge_builders[ctype]()
+    if ctype=="image":
+        with imager.reserve_level() as level:
+            item,stats,stages=run_in_build_process(_build_in_process,ctype,level)
+    else:
+        item,stats,stages=run_in_build_process(_build_in_process,ctype)
+    imager.merge_stats(stats)
+    stage_seconds.merge(stages)
+    return item
+
+# lazy audio challenges are only an id, their frames are built when they are fetched
+audio_lazy=config.get("audio_lazy",False)
+if audio_lazy and not hasattr(challenges,"peek"):
+    print(f"{color_warn}Warning: the challenge store has no peek(), which audio_lazy needs. Audio challenges are built in full.{color_reset}")
+    audio_lazy=False
+frame_cache=FrameCache(config.get("audio_frame_cache",512))
+if audio_lazy and frame_cache.max_frames<settings.steps:
+    print(f"{color_warn}Warning: audio_frame_cache is smaller than steps, every frame request will build the whole challenge again.{color_reset}")
+frame_builds={} # cid -> task building its frames, so requests for frames of the same challenge share one build
+
+def split_lazy_cid(cid):
+    """
+    A lazy audio challenge id is the store id, a dot and the settings version it was issued with
+    (store ids never contain dots). Returns (store id, version), version is None for other ids.
+    """
+    store_cid,sep,version=cid.rpartition(".")
+    if not sep or not version.isdigit():
+        return cid,None
+    return store_cid,int(version)
+
+challenge_pool=ChallengePool(
+    {ctype: functools.partial(build_challenge,ctype) for ctype in challenge_builders},
+    {ctype: mark for ctype, mark in config.get("pool",{}).items() if ctype in config.get("allowed_types",[]) and not (ctype=="audio" and audio_lazy)},
+    workers=config.get("pool_workers",1),
+    version=lambda: settings.version,
+)
+build_limiter=BuildLimiter(
+    challenge_builders,
+    concurrency=config.get("build_concurrency",max(process_workers,2)),
+    queue=config.get("build_queue",16),
+)
+
+async def take_challenge(ctype):
+    """
+    Returns a pooled challenge, or builds one in a thread (which hands it to the process pool if there is one)
+    so the event loop keeps serving other requests. Raises Overloaded if the build queue of the type is full.
+    """
+    item=challenge_pool.take_ready(ctype)
+    if item is not None:
+        return item
+    loop=asyncio.get_running_loop()
+    return await build_limiter.run(ctype,lambda: loop.run_in_executor(None,build_challenge,ctype))
+
+issued_total=metrics.register(metrics.Counter("tinac_challenges_issued_total","Challenges handed out.",["type"]))
+overloaded_total=metrics.register(metrics.Counter("tinac_overloaded_total","Challenge requests turned away with 503 because the build queue was full.",["type"]))
+verify_total=metrics.register(metrics.Counter("tinac_verify_total","Answers checked by /verify.",["type","outcome"]))
+token_checks_total=metrics.register(metrics.Counter("tinac_token_checks_total","Tokens checked by /verify_token and /verify_tokens.",["outcome"]))
+metrics.register(metrics.Gauge("tinac_challenges","Unanswered challenges in the challenge store.",read=lambda: {(): len(challenges)}))
+def read_store_bytes():
+    report=challenges.report()
+    return {(): report.get("memory_bytes",report.get("db_bytes"))}
+metrics.register(metrics.Gauge("tinac_challenges_memory_bytes","Approximate memory (or database size) used by the challenge store.",read=read_store_bytes))
+metrics.register(metrics.Gauge("tinac_pool_depth","Ready challenges in the pool.",["type"],read=lambda: {(ctype,): r["depth"] for ctype,r in challenge_pool.report().items()}))
+
+reload_lock=threading.Lock()
+
+def reload_settings():
+    """
+    Loads config.json and the models again into a new Settings and checks that it can build every
+    allowed challenge type before swapping it in. Challenges issued before stay valid until they expire,
+    the pools are emptied and challenges of the old version still being built are dropped.
+    Frames of lazy audio challenges issued before are refused (410), they would come out different.
+    Returns the new version. Raises if anything fails, the old settings stay in use then.
+    """
+    global settings,build_executor
+    with reload_lock:
+        new=Settings("config.json",settings.version+1,reload_modules=True)
+        allowed=new.config.get("allowed_types",[])
+        for ctype in ("legacy","image"):
+            if ctype in allowed:
+                challenge_builders[ctype](new)
+        if "audio" in allowed:
+            # with an rng the generator cuts snippets itself and doesn't start its bank thread,
+            # no thread may be running here when the build processes are forked below
+            rng=random.Random()
+            new.audio_generator.generate_real("0123",rng=rng)
+            new.audio_generator.generate_decoy(4,rng=rng)
+        if build_executor is not None:
+            challenge_pool.stop()
+        # swapped together under the lock, so frames waiting in build_frames see both or neither
+        with executor_lock:
+            old=settings
+            settings=new
+            if build_executor is not None:
+                # the build processes were forked with the old settings, fork new ones
+                old_executor=build_executor
+                build_executor=new_build_executor()
+                old_executor.shutdown(wait=False)
+        imager.level=new.zlib_level
+        if hasattr(old.audio_generator,"close"):
+            old.audio_generator.close()
+        if new.jwt_secret!=old.jwt_secret:
+            token_cache.clear()
+        frame_cache.clear() # frames of the old version are not served anymore
+        if build_executor is not None:
+            challenge_pool.start()
+        dropped=challenge_pool.clear()
+    print(f"{color_acc}Reloaded config.json and models, now serving version {new.version} ({dropped} pooled challenges dropped).{color_reset}")
+    return new.version
+
+def reload_from_signal():
+    try:
+        reload_settings()
+    except Exception as e:
+        print(f"{color_err}Error: reload failed, still serving version {settings.version}:{color_reset}",e)
+
+def busy_response(e,ctype):
+    overloaded_total.inc(ctype)
+    return JSONResponse({"error":"Server busy, try again later."},status_code=503,headers={"Retry-After":str(e.retry_after)})
+
+@app.get("/challenge")
+async def get_challenge():
+    if "legacy" not in settings.config.get("allowed_types",[]):
+        return {"error":"Legacy challenges are disabled."}
+    try:
+        challenge,correct_index,challenges_list,version=await take_challenge("legacy")
+    except Overloaded as e:
+        return busy_response(e,"legacy")
+    cid=challenges.issue("legacy_",challenge,correct_index)
+    issued_total.inc("legacy")
+    return JSONResponse({"id":cid,"challenge":challenges_list,"steps":len(challenges_list),"version":version},headers={"X-TINAC-Version":str(version)})
+
+
+
+@app.get("/challenge_img")
+async def get_challenge_img(request: Request):
+    if "image" not in settings.config.get("allowed_types",[]):
+        return {"error":"Image challenges are disabled."}
+    try:
+        challenge,correct_index,imgdata,version=await take_challenge("image")
+    except Overloaded as e:
+        return busy_response(e,"image")
+    cid=challenges.issue("image_",challenge,correct_index)
+    issued_total.inc("image")
+    if wireformat.accepts(request.headers.get("accept")):
+        body=wireformat.encode(wireformat.KIND_IMAGE,cid,[imgdata["data"]],imgdata["count"],imgdata["width"],imgdata["height"],imgdata["count"])
+        return Response(body,media_type=wireformat.MEDIA_TYPE,headers={"X-TINAC-Version":str(version)})
+    with stage_seconds.time("base64"):
+        imgdata=dict(imgdata,data=base64.b64encode(imgdata["data"]).decode('utf-8'))
+    return JSONResponse({"id":cid,"challenge":imgdata,"steps":imgdata["count"],"version":version},headers={"X-TINAC-Version":str(version)})
 
 @app.get("/challenge_audio")
-def get_audio_challenge():
-    if "audio" not in config.get("allowed_types",[]):
+async def get_audio_challenge(request: Request):
+    if "audio" not in settings.config.get("allowed_types",[]):
         return {"error":"Audio challenges are disabled."}
-    global charlens
-    global audio_generator
-    cid="audio_"+secrets.token_urlsafe(32)
-    challenge="".join(secrets.choice(chars) for _ in range(secrets.choice(charlens)))
-    if len(challenges)>100000000: # approx 4GB ram usage limit
-        challenges.popitem(last=False)
-    correct_index=secrets.randbelow(steps+1)
-    challenges[cid]=[challenge,correct_index]
-    challenges_list = []
-    for i in range(steps):
-        if i == correct_index:
-            audio_seg = audio_generator.segment_to_base64(audio_generator.generate_real(challenge))
-            challenges_list.append(audio_seg)
-        else:
-            audio_seg = audio_generator.segment_to_base64(audio_generator.generate_decoy(len(challenge)))
-            challenges_list.append(audio_seg)
-    return {"id": cid, "challenge": challenges_list, "steps": steps}
+    if audio_lazy:
+        s=settings
+        challenge,correct_index=pick_audio_answer(s)
+        cid=f'{challenges.issue("audio_",challenge,correct_index)}.{s.version}'
+        issued_total.inc("audio")
+        if wireformat.accepts(request.headers.get("accept")):
+            body=wireformat.encode(wireformat.KIND_AUDIO,cid,[],s.steps,count=s.steps)
+            return Response(body,media_type=wireformat.MEDIA_TYPE,headers={"X-TINAC-Version":str(s.version)})
+        return JSONResponse({"id":cid,"steps":s.steps,"lazy":True,"media_type":audio_media_type(s.audio_generator),"version":s.version},headers={"X-TINAC-Version":str(s.version)})
+    try:
+        challenge,correct_index,challenges_list,version=await take_challenge("audio")
+    except Overloaded as e:
+        return busy_response(e,"audio")
+    cid=challenges.issue("audio_",challenge,correct_index)
+    issued_total.inc("audio")
+    if wireformat.accepts(request.headers.get("accept")):
+        body=wireformat.encode(wireformat.KIND_AUDIO,cid,challenges_list,len(challenges_list))
+        return Response(body,media_type=wireformat.MEDIA_TYPE,headers={"X-TINAC-Version":str(version)})
+    with stage_seconds.time("base64"):
+        challenges_list=[base64.b64encode(data).decode('utf-8') for data in challenges_list]
+    return JSONResponse({"id": cid, "challenge": challenges_list, "steps": len(challenges_list), "media_type": audio_media_type(settings.audio_generator), "version": version},headers={"X-TINAC-Version":str(version)})
+
+@app.get("/challenge_audio/{cid}/{index}")
+async def get_audio_frame(cid: str, index: int):
+    """
+    Returns frame `index` of a lazy audio challenge as media_type. All frames are built when the first one is asked for.
+    """
+    if not audio_lazy or "audio" not in settings.config.get("allowed_types",[]):
+        return JSONResponse({"error":"Lazy audio challenges are disabled."},status_code=404)
+    s=settings
+    store_cid,version=split_lazy_cid(cid)
+    entry=challenges.peek(store_cid) if cid.startswith("audio_") and version is not None else None
+    if entry is None:
+        return JSONResponse({"error":"Invalid or expired ID"},status_code=404)
+    if version!=s.version:
+        return JSONResponse({"error":"The challenge was issued before the server reloaded its settings, get a new one."},status_code=410)
+    if not 0<=index<s.steps:
+        return JSONResponse({"error":"No such frame"},status_code=404)
+    challenge,correct_index=entry
+    data=frame_cache.get(cid,index)
+    if data is None:
+        task=frame_builds.get(cid)
+        if task is None:
+            loop=asyncio.get_running_loop()
+            task=asyncio.ensure_future(build_limiter.run("audio",lambda: loop.run_in_executor(None,build_frames,s,cid,challenge,correct_index)))
+            frame_builds[cid]=task
+            task.add_done_callback(lambda _: frame_builds.pop(cid,None))
+        try:
+            # shielded, so a client that goes away doesn't cancel the build other requests wait for
+            frames=await asyncio.shield(task)
+        except Overloaded as e:
+            return busy_response(e,"audio")
+        if frames is None:
+            return JSONResponse({"error":"The challenge was issued before the server reloaded its settings, get a new one."},status_code=410)
+        frame_cache.put(cid,frames)
+        data=frames[index]
+    return Response(data,media_type=audio_media_type(s.audio_generator))
+
+@app.get("/pool")
+def get_pool_stats():
+    """
+    Returns depth, watermark, hit/miss counts and refill rate of each challenge pool,
+    and the state of the build queue that requests wait in when a pool is empty.
+    """
+    report=challenge_pool.report()
+    for ctype,queue in build_limiter.report().items():
+        report[ctype]["build_queue"]=queue
+    if hasattr(settings.audio_generator,"bank_report") and "audio" in report:
+        report["audio"]["snippet_bank"]=settings.audio_generator.bank_report()
+    if audio_lazy and "audio" in report:
+        report["audio"]["frame_cache"]=frame_cache.report()
+    return report
 
+@app.get("/compression")
+def get_compression_stats():
+    """
+    Returns the zlib level setting and the achieved compression ratio of image bundles.
+    """
+    return imager.report()
 
+@app.get("/store")
+def get_store_stats():
+    """
+    Returns size, approximate memory use and expiry counters of the challenge store.
+    """
+    return challenges.report()
 
 
 @app.post("/verify")
@@ -368,12 +903,17 @@ def verify_answer(payload: dict):
     cid=payload.get("id",None)
     answer=payload.get("answer",None)
     index=payload.get("index",None)
-    if cid not in challenges:
+    if cid is None:
+        verify_total.inc("unknown","bad_request")
+        return {"error":"id parameter required"}
+    if isinstance(cid,str):
+        store_cid,_=split_lazy_cid(cid)
+    if not isinstance(cid,str) or store_cid not in challenges:
+        verify_total.inc("unknown","invalid_id")
         return {"error":"Invalid or expired ID"}
     if answer is None:
+        verify_total.inc("unknown","bad_request")
         return {"error":"answer parameter required"}
-    if cid is None:
-        return {"error":"id parameter required"}
     if cid.startswith("audio_"):
         ctype="audio"
     elif cid.startswith("image_"):
@@ -382,9 +922,16 @@ def verify_answer(payload: dict):
         ctype="legacy"
     else:
         print(f"{color_warn}Warning: A challenge ID with invalid prefix was issued by the server:{color_reset} {cid}")
+        verify_total.inc("unknown","invalid_id")
         return {"error":"Invalid or expired ID"}
     
-    correct_answer,correct_index=challenges.pop(cid)
+    entry=challenges.pop(store_cid)
+    if entry is None:
+        verify_total.inc(ctype,"invalid_id")
+        return {"error":"Invalid or expired ID"}
+    correct_answer,correct_index=entry
+    if ctype=="audio":
+        frame_cache.discard(cid)
     response={"answer": answer==correct_answer}
     if index is not None:
         response["index"]= index==correct_index
@@ -396,24 +943,241 @@ def verify_answer(payload: dict):
         "iat": int(time.time()),
         "exp": int(time.time()) + 300  # Token expires in 5 minutes
     }
-    token = jwt.encode(jwt_payload, jwt_secret, algorithm="HS256")
+    verify_total.inc(ctype,"correct" if jwt_payload["answer"] and (index is None or jwt_payload["index"]) else "wrong")
+    with stage_seconds.time("jwt_sign"):
+        token = jwt.encode(jwt_payload, settings.jwt_secret, algorithm="HS256")
     response["token"] = token
     return response
 
+token_cache=VerifiedTokenCache(config.get("token_cache_size",10000))
+max_token_batch=config.get("max_token_batch",1000)
+
+def check_token(token, expected_type=None):
+    if not isinstance(token,str):
+        token_checks_total.inc("invalid")
+        return {"valid": False, "error": "Invalid token"}
+    decoded=token_cache.get(token)
+    if decoded is None:
+        try:
+            with stage_seconds.time("jwt_verify"):
+                decoded = jwt.decode(token, settings.jwt_secret, algorithms=["HS256"])
+        except jwt.ExpiredSignatureError:
+            token_checks_total.inc("expired")
+            return {"valid": False, "error": "Token has expired"}
+        except jwt.InvalidTokenError:
+            token_checks_total.inc("invalid")
+            return {"valid": False, "error": "Invalid token"}
+        token_cache.put(token,decoded)
+    if expected_type is not None and decoded.get("type")!=expected_type:
+        token_checks_total.inc("wrong_type")
+        return {"valid": False, "error": "Token is for a different captcha type"}
+    token_checks_total.inc("valid")
+    return {"valid": True, "data": decoded}
+
 @app.post("/verify_token")
 def verify_token(payload: dict):
     token=payload.get("token",None)
     if token is None:
         return {"error":"token parameter required"}
+    return check_token(token,payload.get("expected_type",None))
+
+@app.post("/verify_tokens")
+def verify_tokens(payload: dict):
+    """
+    Checks many tokens in one request, results are in the same order as the tokens.
+    """
+    tokens=payload.get("tokens",None)
+    if not isinstance(tokens,list):
+        return {"error":"tokens parameter required"}
+    if len(tokens)>max_token_batch:
+        return {"error":f"At most {max_token_batch} tokens per request"}
+    expected_type=payload.get("expected_type",None)
+    return {"results":[check_token(token,expected_type) for token in tokens]}
+
+@app.post("/admin/reload")
+async def admin_reload(request: Request):
+    """
+    Reloads config.json and the models without a restart. Needs "Authorization: Bearer <admin_token>".
+    """
+    admin_token=settings.config.get("admin_token",None)
+    if not admin_token:
+        return JSONResponse({"error":"Admin endpoints are disabled. Set admin_token in config.json."},status_code=404)
+    if not hmac.compare_digest(request.headers.get("authorization","").encode(),f"Bearer {admin_token}".encode()):
+        return JSONResponse({"error":"Unauthorized"},status_code=401)
     try:
-        decoded = jwt.decode(token, jwt_secret, algorithms=["HS256"])
-        return {"valid": True, "data": decoded}
-    except jwt.ExpiredSignatureError:
-        return {"valid": False, "error": "Token has expired"}
-    except jwt.InvalidTokenError:
-        return {"valid": False, "error": "Invalid token"}
+        version=await asyncio.get_running_loop().run_in_executor(None,reload_settings)
+    except Exception as e:
+        print(f"{color_err}Error: reload failed, still serving version {settings.version}:{color_reset}",e)
+        return JSONResponse({"error":f"Reload failed, still serving version {settings.version}: {e}"},status_code=500)
+    return {"version":version}
+
+@app.get("/metrics",response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Prometheus text format: per stage latency histograms, store and pool gauges, challenge and verify counters.
+    """
+    return PlainTextResponse(metrics.render(),media_type="text/plain; version=0.0.4")
+
+@app.get("/token_cache")
+def get_token_cache_stats():
+    """
+    Returns size and hit/miss counts of the verified token cache.
+    """
+    return token_cache.report()
     
 
+def memory_kb(pid):
+    """
+    Returns (rss, pss) of a process in kB. pss counts pages shared with other processes
+    divided between them, so it shows what copy-on-write saves. pss is None if the kernel doesn't report it.
+    """
+    values={}
+    for path in (f"/proc/{pid}/smaps_rollup",f"/proc/{pid}/status"):
+        try:
+            with open(path) as f:
+                for line in f:
+                    name,_,rest=line.partition(":")
+                    if name in ("Rss","Pss","VmRSS"):
+                        values[name]=int(rest.split()[0])
+        except OSError:
+            continue
+    return values.get("Rss",values.get("VmRSS")),values.get("Pss")
+
+def serve_worker(sock,ready_fd,forked_at):
+    """
+    Runs uvicorn on the listening socket inherited from the master and reports startup time once it is serving.
+    """
+    server=uvicorn.Server(uvicorn.Config(app,lifespan="on"))
+    master=os.getppid()
+    async def run():
+        task=asyncio.create_task(server.serve(sockets=[sock]))
+        while not server.started and not task.done():
+            await asyncio.sleep(0.01)
+        if server.started and ready_fd is not None:
+            os.write(ready_fd,f"{os.getpid()} {time.monotonic()-forked_at:.3f}\n".encode())
+            os.close(ready_fd) # the master sees EOF once every worker closed its end
+        # shut down if the master is gone (e.g. killed with SIGKILL) instead of being left orphaned
+        while not task.done():
+            if os.getppid()!=master:
+                server.should_exit=True
+            await asyncio.wait([task],timeout=1)
+        await task
+    asyncio.run(run())
+
+def serve(host="0.0.0.0",port=3456,workers=1,ready_timeout=120):
+    """
+    Prefork mode. Models, compiled tables and audio caches are already loaded (at import),
+    the workers are forked from this process and share that memory copy-on-write.
+    The master waits up to ready_timeout seconds for the workers to report that they are serving.
+    """
+    if workers>1 and config.get("challenge_store","memory")=="memory":
+        print(f"{color_warn}Warning: challenge_store is memory, each worker has its own challenges and answers sent to another worker will fail. Use sqlite.{color_reset}")
+    sock=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    sock.bind((host,port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    print(f"{color_acc}Models loaded in {time.monotonic()-load_started:.2f}s, forking {workers} workers.{color_reset}")
+    # objects that exist now are never collected, so the gc doesn't write to (and un-share) their pages
+    gc.collect()
+    gc.freeze()
+    ready_r,ready_w=os.pipe()
+    children={}
+    def spawn(ready_fd=None):
+        forked_at=time.monotonic()
+        pid=os.fork()
+        if pid==0:
+            if ready_fd is not None:
+                os.close(ready_r)
+            signal.signal(signal.SIGINT,signal.SIG_DFL)
+            signal.signal(signal.SIGTERM,signal.SIG_DFL)
+            signal.signal(signal.SIGHUP,signal.SIG_IGN) # until lifespan sets up reloading
+            code=0
+            try:
+                serve_worker(sock,ready_fd,forked_at)
+            except BaseException as e:
+                print(f"{color_err}Worker {os.getpid()} failed:{color_reset}",e)
+                code=1
+            finally:
+                if ready_fd is not None:
+                    try:
+                        os.close(ready_fd) # not reported ready, don't keep the master waiting
+                    except OSError:
+                        pass # already closed after reporting
+                os._exit(code)
+        children[pid]=forked_at
+    stopping=False
+    def stop(signum,frame):
+        nonlocal stopping
+        stopping=True
+        for pid in list(children):
+            try:
+                os.kill(pid,signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    def reload(signum,frame):
+        # every worker reloads on its own
+        for pid in list(children):
+            try:
+                os.kill(pid,signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGINT,stop)
+    signal.signal(signal.SIGTERM,stop)
+    signal.signal(signal.SIGHUP,reload)
+    for _ in range(workers):
+        spawn(ready_w)
+    os.close(ready_w) # once every worker reported or exited, reading hits EOF
+    started={}
+    pending=b""
+    deadline=time.monotonic()+ready_timeout
+    try:
+        while len(started)<workers and not stopping:
+            remaining=deadline-time.monotonic()
+            if remaining<=0:
+                print(f"{color_warn}Warning: only {len(started)} of {workers} workers were serving after {ready_timeout}s, not waiting for the rest.{color_reset}")
+                break
+            # a worker stuck in startup keeps its end open, so never block without a timeout
+            readable,_,_=select.select([ready_r],[],[],min(remaining,1.0))
+            if not readable:
+                continue
+            chunk=os.read(ready_r,4096)
+            if not chunk:
+                break # every worker reported or exited
+            *lines,pending=(pending+chunk).split(b"\n")
+            for line in lines:
+                pid,seconds=line.split()
+                started[int(pid)]=float(seconds)
+    finally:
+        os.close(ready_r)
+    rss,pss=memory_kb(os.getpid())
+    print(f"{color_acc}master {os.getpid()}: rss {rss} kB, pss {pss} kB{color_reset}")
+    for pid in children:
+        rss,pss=memory_kb(pid)
+        startup=f"started in {started[pid]:.2f}s" if pid in started else "not serving yet"
+        print(f"{color_acc}worker {pid}: {startup}, rss {rss} kB, pss {pss} kB{color_reset}")
+    while children:
+        try:
+            pid,status=os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.pop(pid,None)
+        if not stopping:
+            print(f"{color_warn}Warning: worker {pid} exited ({status}), starting a new one.{color_reset}")
+            spawn()
+
 if __name__ == "__main__":
-    port = sys.argv[1] if len(sys.argv) > 1 else 3456
-    uvicorn.run("backend:app", host="0.0.0.0", port=int(port), reload=True)
\ No newline at end of file
+    if sys.argv[1:2]==["serve"]:
+        import argparse
+        parser=argparse.ArgumentParser(prog="backend.py serve",description="Run TINAC with prefork workers that share the loaded models.")
+        parser.add_argument("--workers",type=int,default=os.cpu_count() or 1)
+        parser.add_argument("--host",default="0.0.0.0")
+        parser.add_argument("--port",type=int,default=3456)
+        parser.add_argument("--ready-timeout",type=float,default=120,help="seconds to wait for the workers to start serving (default 120)")
+        args=parser.parse_args(sys.argv[2:])
+        serve(args.host,args.port,max(1,args.workers),args.ready_timeout)
+    else:
+        port = sys.argv[1] if len(sys.argv) > 1 else 3456
+        uvicorn.run("backend:app", host="0.0.0.0", port=int(port), reload=True)
\ No newline at end of file
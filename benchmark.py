@@ -0,0 +1,270 @@
+"""
+Offline benchmarks for the challenge pipeline, run against the models and audio in this folder.
+
+    python benchmark.py                          run everything and print a table
+    python benchmark.py --save bench.json        also write the results as a baseline
+    python benchmark.py --compare bench.json     flag benchmarks whose p50 got slower than the baseline
+    python benchmark.py --only zlib,endpoint     only benchmarks whose name contains one of these
+
+Micro benchmarks time one stage at a time (FIGlet, decoys, rasterizing, zlib, audio, JWT).
+Macro benchmarks call the endpoints through an in-process ASGI client with the pools turned off,
+so every request builds its challenge. Exits with 1 if --compare found a regression.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import secrets
+import shutil
+import statistics
+import sys
+import time
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    def pct(p):
+        return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+    total = sum(samples)
+    return {
+        "n": len(samples),
+        "ops_per_sec": round(len(samples) / total, 2) if total else None,
+        "mean_ms": round(1000 * statistics.fmean(samples), 3),
+        "p50_ms": round(1000 * pct(50), 3),
+        "p99_ms": round(1000 * pct(99), 3),
+    }
+
+
+def measure(fn, min_time, min_runs=5, max_runs=10000):
+    fn() # warm up caches, lazy imports and the like
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < min_runs or (time.perf_counter() - started < min_time and len(samples) < max_runs):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return summarize(samples)
+
+
+async def measure_async(fn, min_time, min_runs=5, max_runs=10000):
+    await fn()
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < min_runs or (time.perf_counter() - started < min_time and len(samples) < max_runs):
+        t = time.perf_counter()
+        await fn()
+        samples.append(time.perf_counter() - t)
+    return summarize(samples)
+
+
+def micro_benchmarks(backend):
+    """
+    Returns {name: zero-argument function}, one per pipeline stage.
+    """
+    import jwt
+    import zlib
+    challenge = "".join(secrets.choice(backend.settings.chars) for _ in range(max(backend.settings.charlens)))
+    fonts = [secrets.choice(backend.settings.good_fonts) for _ in challenge]
+    pairs = list(zip(challenge, fonts))
+    _, _, frames, _ = backend.build_text_challenge()
+    art_lines = frames[0].split("\n")
+    linelen, lineheight = max(len(line) for line in art_lines), len(art_lines)
+    bundle = backend.imager.pack_bundle(frames)
+    width, height = bundle["width"], bundle["height"]
+    raw_bits = zlib.decompress(bundle["data"])
+    level = backend.imager.level if backend.imager.level != "auto" else 9
+    token = jwt.encode({"type": "image", "iat": int(time.time()), "exp": int(time.time()) + 3600}, backend.settings.jwt_secret, algorithm="HS256")
+
+    benches = {
+        "figlet.asciiart": lambda: backend.asciiart(pairs),
+        f"decoys.{backend.settings.deceptor}": lambda: backend.settings.generate_decoys(linelen, lineheight, challenge, backend.settings.steps - 1),
+        "image.render_frames": lambda: [backend.imager._render_frame(text, width, height) for text in frames],
+        "image.pack_bundle": lambda: backend.imager.pack_bundle(frames),
+        f"image.zlib_level{level}": lambda: zlib.compress(raw_bits, level=level),
+        "build.legacy": backend.build_text_challenge,
+        "build.image": backend.build_image_challenge,
+        "jwt.sign": lambda: jwt.encode({"type": "image", "exp": int(time.time()) + 300}, backend.settings.jwt_secret, algorithm="HS256"),
+        "jwt.verify": lambda: jwt.decode(token, backend.settings.jwt_secret, algorithms=["HS256"]),
+    }
+    if os.path.exists("model.bin"):
+        from compiledchain import CompiledMarkovChain
+        chain = CompiledMarkovChain("model.bin")
+        benches["decoys.compiled_markov.generate"] = lambda: chain.generate(linelen * lineheight)
+    if os.path.exists("model.json"):
+        from trainchain import AsciiMarkovChain
+        chain_json = AsciiMarkovChain.load_from_json("model.json")
+        benches["decoys.AsciiMarkovChain.generate"] = lambda: chain_json.generate(linelen * lineheight)
+    try:
+        import markov2d
+        benches["decoys.markov2d.generate_decoy"] = lambda: markov2d.generate_decoy(linelen, lineheight, challenge)
+    except Exception as e:
+        print("Skipping markov2d:", e)
+    audio = backend.settings.audio_generator
+    digits = "".join(secrets.choice("0123456789") for _ in range(max(backend.settings.charlens)))
+    benches["audio.generate_real"] = lambda: audio.generate_real(digits)
+    benches["audio.generate_decoy"] = lambda: audio.generate_decoy(len(digits))
+    if hasattr(audio, "_make_snippet"):
+        benches["audio.make_snippet"] = lambda: audio._make_snippet(secrets.randbelow(len(audio.decoy_sources)))
+    segments = [audio.generate_decoy(len(digits)) for _ in range(backend.settings.steps)]
+    mp3 = getattr(audio, "_mp3", None)
+    if hasattr(audio, "segments_to_mp3") and (has_ffmpeg() or not getattr(mp3, "needs_ffmpeg", True)):
+        benches["audio.segments_to_mp3"] = lambda: audio.segments_to_mp3(segments)
+    encoder = getattr(audio, "encoder", None)
+    if encoder is not None and encoder.name != "mp3" and can_encode(backend):
+        benches[f"audio.encode.{encoder.name}"] = lambda: encoder.encode(segments)
+    if can_encode(backend):
+        benches["build.audio"] = backend.build_audio_challenge
+    return benches
+
+
+def has_ffmpeg():
+    return shutil.which("ffmpeg") is not None or shutil.which("avconv") is not None
+
+
+def can_encode(backend):
+    encoder = getattr(backend.settings.audio_generator, "encoder", None)
+    return has_ffmpeg() or not getattr(encoder, "needs_ffmpeg", True)
+
+
+async def macro_benchmarks(backend, min_time):
+    try:
+        import httpx
+    except ImportError:
+        print("Skipping the endpoint benchmarks, they need httpx (pip install httpx).")
+        return {}
+    # no pools, so each request pays for building its challenge
+    backend.challenge_pool.watermarks = {ctype: 0 for ctype in backend.challenge_pool.watermarks}
+    allowed = backend.config.get("allowed_types", [])
+    results = {}
+    async with backend.lifespan(backend.app):
+        transport = httpx.ASGITransport(app=backend.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            async def get(path, headers=None):
+                response = await client.get(path, headers=headers)
+                response.raise_for_status()
+                return response
+            endpoints = []
+            if "legacy" in allowed:
+                endpoints.append(("endpoint./challenge", lambda: get("/challenge")))
+            if "image" in allowed:
+                endpoints.append(("endpoint./challenge_img", lambda: get("/challenge_img")))
+                endpoints.append(("endpoint./challenge_img.binary", lambda: get("/challenge_img", {"Accept": "application/octet-stream"})))
+            if "audio" in allowed and can_encode(backend):
+                if backend.audio_lazy:
+                    # a lazy challenge is only an id, the audio work is in the first frame request
+                    endpoints.append(("endpoint./challenge_audio.lazy_id", lambda: get("/challenge_audio")))
+                    async def frame():
+                        cid = (await get("/challenge_audio")).json()["id"]
+                        started = time.perf_counter()
+                        await get(f"/challenge_audio/{cid}/0")
+                        return time.perf_counter() - started
+                    endpoints.append(("endpoint./challenge_audio/{id}/{index}", frame))
+                else:
+                    endpoints.append(("endpoint./challenge_audio", lambda: get("/challenge_audio")))
+            if allowed:
+                ctype = "image" if "image" in allowed else allowed[0]
+                path = {"legacy": "/challenge", "image": "/challenge_img", "audio": "/challenge_audio"}[ctype]
+                async def verify():
+                    cid = (await get(path)).json()["id"]
+                    started = time.perf_counter()
+                    response = await client.post("/verify", json={"id": cid, "answer": "wrong"})
+                    response.raise_for_status()
+                    return time.perf_counter() - started
+                endpoints.append(("endpoint./verify", verify))
+            for name, fn in endpoints:
+                if not selected(name):
+                    continue
+                if name in ("endpoint./verify", "endpoint./challenge_audio/{id}/{index}"):
+                    # only the second call is timed, not the challenge it needs
+                    await fn()
+                    samples = []
+                    started = time.perf_counter()
+                    while len(samples) < 5 or time.perf_counter() - started < min_time:
+                        samples.append(await fn())
+                    results[name] = summarize(samples)
+                else:
+                    results[name] = await measure_async(fn, min_time)
+                print_row(name, results[name])
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the names of benchmarks whose p50 is more than `threshold` (a fraction) slower than the baseline.
+    """
+    regressions = []
+    print()
+    print(f"{'benchmark':<40}{'baseline p50':>14}{'p50':>12}{'change':>10}")
+    for name, old in sorted(baseline["results"].items()):
+        new = results.get(name)
+        if new is None:
+            continue
+        change = new["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{name:<40}{old['p50_ms']:>14.3f}{new['p50_ms']:>12.3f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def print_row(name, result):
+    print(f"{name:<40}{result['n']:>7}{result['ops_per_sec']:>12}{result['p50_ms']:>12.3f}{result['p99_ms']:>12.3f}")
+
+
+_only = []
+
+
+def selected(name):
+    return not _only or any(part in name for part in _only)
+
+
+def main():
+    global _only
+    parser = argparse.ArgumentParser(description="Benchmark the TINAC challenge pipeline.")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against a JSON file written by --save")
+    parser.add_argument("--threshold", type=float, default=0.15, help="slowdown of p50 counted as a regression (default 0.15 = 15%%)")
+    parser.add_argument("--time", type=float, default=1.0, help="seconds to spend on each benchmark (default 1)")
+    parser.add_argument("--only", default="", help="comma separated substrings of benchmark names to run")
+    parser.add_argument("--no-macro", action="store_true", help="skip the endpoint benchmarks")
+    args = parser.parse_args()
+    _only = [part for part in args.only.split(",") if part]
+
+    import backend # loads config, models and audio just like the server
+    print()
+    print(f"{'benchmark':<40}{'runs':>7}{'ops/s':>12}{'p50 ms':>12}{'p99 ms':>12}")
+    results = {}
+    for name, fn in micro_benchmarks(backend).items():
+        if selected(name):
+            results[name] = measure(fn, args.time)
+            print_row(name, results[name])
+    if not args.no_macro:
+        results.update(asyncio.run(macro_benchmarks(backend, args.time)))
+
+    report = {
+        "created": int(time.time()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+
+
+class Overloaded(Exception):
+    """
+    Raised by BuildLimiter when too many requests are already waiting for a build.
+    retry_after is the estimated number of seconds until there is room again.
+    """
+    def __init__(self, retry_after):
+        super().__init__(f"build queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class ChallengePool:
+    """
+    Keeps a queue of ready-made challenges per type so requests only pop one.
+    builders maps a type to a function that returns a fresh challenge tuple,
+    watermarks maps a type to how many ready challenges to keep around.
+    version returns the current settings version. Each challenge is tagged with the version from
+    when its build started, and challenges of another version are dropped instead of handed out.
+    """
+    def __init__(self, builders, watermarks, workers=1, version=None):
+        self.builders = builders
+        self.version = version or (lambda: None)
+        self.watermarks = {t: int(watermarks.get(t, 0)) for t in builders}
+        self.workers = max(1, int(workers))
+        self.ready = {t: deque() for t in builders}
+        self.stats = {t: {"hits": 0, "misses": 0, "generated": 0, "stale": 0, "build_seconds": 0.0} for t in builders}
+        self._recent = {t: deque(maxlen=256) for t in builders} # finish times of recent refills
+        self._building = {t: 0 for t in builders}
+        self._backoff_until = {t: 0.0 for t in builders} # refills of a failing type are paused
+        self._cond = threading.Condition()
+        self._threads = []
+        self._running = False
+
+    def start(self):
+        if self._running or not any(self.watermarks.values()):
+            return
+        self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"challenge-pool-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stops the refill threads, after they finish the challenges they are building. Waiting for them
+        means start() never runs a new set of threads next to old ones still building.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def take_ready(self, ctype):
+        """
+        Pops a ready challenge, or returns None (counted as a miss) if the pool is empty.
+        """
+        version = self.version()
+        with self._cond:
+            while self.ready[ctype]:
+                item_version, item = self.ready[ctype].popleft()
+                self._cond.notify()
+                if item_version != version:
+                    self.stats[ctype]["stale"] += 1
+                    continue
+                self.stats[ctype]["hits"] += 1
+                return item
+            self.stats[ctype]["misses"] += 1
+        return None
+
+    def clear(self):
+        """
+        Drops all ready challenges (e.g. after a reload), the workers refill the pools.
+        Returns how many were dropped.
+        """
+        with self._cond:
+            dropped = sum(len(ready) for ready in self.ready.values())
+            for ready in self.ready.values():
+                ready.clear()
+            self._cond.notify_all()
+        return dropped
+
+    def _next_type(self):
+        # the type with the emptiest pool (relative to its watermark) goes first
+        best, best_fill = None, 1.0
+        now = time.perf_counter()
+        for ctype, mark in self.watermarks.items():
+            if mark <= 0 or self._backoff_until[ctype] > now:
+                continue
+            fill = (len(self.ready[ctype]) + self._building[ctype]) / mark
+            if fill < best_fill:
+                best, best_fill = ctype, fill
+        return best
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                ctype = self._next_type()
+                while self._running and ctype is None:
+                    self._cond.wait(timeout=1)
+                    ctype = self._next_type()
+                if not self._running:
+                    return
+                self._building[ctype] += 1
+            started = time.perf_counter()
+            version = self.version()
+            try:
+                item = self.builders[ctype]()
+            except Exception as e:
+                print(f"Warning: pool refill for {ctype} failed, retrying in 30s:", e)
+                item = None
+            finished = time.perf_counter()
+            with self._cond:
+                self._building[ctype] -= 1
+                if item is None:
+                    self._backoff_until[ctype] = finished + 30
+                if item is not None and version != self.version():
+                    # settings were reloaded during the build (after clear()), don't keep it
+                    self.stats[ctype]["stale"] += 1
+                elif item is not None:
+                    self.ready[ctype].append((version, item))
+                    self.stats[ctype]["generated"] += 1
+                    self.stats[ctype]["build_seconds"] += finished - started
+                    self._recent[ctype].append(finished)
+
+    def report(self):
+        now = time.perf_counter()
+        out = {}
+        with self._cond:
+            for ctype in self.builders:
+                stats = self.stats[ctype]
+                recent = [t for t in self._recent[ctype] if now - t <= 60]
+                out[ctype] = {
+                    "depth": len(self.ready[ctype]),
+                    "watermark": self.watermarks[ctype],
+                    "hits": stats["hits"],
+                    "misses": stats["misses"],
+                    "generated": stats["generated"],
+                    "stale": stats["stale"],
+                    "avg_build_ms": round(1000 * stats["build_seconds"] / stats["generated"], 2) if stats["generated"] else None,
+                    "refill_per_sec": round(len(recent) / 60, 3),
+                }
+        return out
+
+
+class BuildLimiter:
+    """
+    Bounds the builds requests wait for when the pool is empty.
+    At most `concurrency` builds of a type run at once and at most `queue` more requests
+    wait for a slot, anything past that gets Overloaded right away instead of waiting.
+    """
+    def __init__(self, types, concurrency=2, queue=16):
+        self.concurrency = max(1, int(concurrency))
+        self.queue = max(0, int(queue))
+        self._slots = {t: asyncio.Semaphore(self.concurrency) for t in types}
+        self._pending = {t: 0 for t in types} # running + waiting
+        self._build_seconds = {t: None for t in types} # moving average of build time
+        self.rejected = {t: 0 for t in types}
+
+    def retry_after(self, ctype):
+        # time for the builds ahead of us to drain, 1s per build until one was measured
+        build_seconds = self._build_seconds[ctype] or 1.0
+        return max(1, math.ceil(build_seconds * self._pending[ctype] / self.concurrency))
+
+    async def run(self, ctype, build):
+        """
+        Awaits build() (a coroutine function) once a slot is free.
+        """
+        if self._pending[ctype] >= self.concurrency + self.queue:
+            self.rejected[ctype] += 1
+            raise Overloaded(self.retry_after(ctype))
+        self._pending[ctype] += 1
+        try:
+            async with self._slots[ctype]:
+                started = time.perf_counter()
+                result = await build()
+                elapsed = time.perf_counter() - started
+                previous = self._build_seconds[ctype]
+                self._build_seconds[ctype] = elapsed if previous is None else 0.8 * previous + 0.2 * elapsed
+                return result
+        finally:
+            self._pending[ctype] -= 1
+
+    def report(self):
+        return {
+            ctype: {
+                "pending": self._pending[ctype],
+                "limit": self.concurrency + self.queue,
+                "rejected": self.rejected[ctype],
+                "avg_build_ms": round(1000 * self._build_seconds[ctype], 2) if self._build_seconds[ctype] is not None else None,
+            }
+            for ctype in self._slots
+        }
@@ -0,0 +1,406 @@
+"""
+Challenge stores. Every store has the same small interface, used by backend.py:
+    issue(prefix, answer, index)       register a new challenge, returns its id (prefix + something unique)
+    pop(cid)                           atomically remove it, returns (answer, index) or None if missing/expired
+    peek(cid)                          same as pop but leaves the challenge in place (lazy audio frames)
+    cid in store, len(store)
+    sweep()                            drop expired entries
+    report()                           dict of stats for GET /store
+ChallengeStore keeps everything in process memory, SQLiteChallengeStore keeps it in a
+SQLite database in WAL mode so several server processes (or nodes sharing the file) can serve
+the same challenges. SignedChallengeStore keeps nothing per challenge: the id itself is an
+encrypted, authenticated token, so any node with the same jwt_secret can verify it.
+A custom store module needs a create_store(config) function.
+"""
+import base64
+import hashlib
+import heapq
+import hmac
+import importlib
+import os
+import secrets
+import sqlite3
+import struct
+import sys
+import threading
+import time
+
+
+class _Record:
+    __slots__ = ("answer", "index", "expires")
+
+    def __init__(self, answer, index, expires):
+        self.answer = answer
+        self.index = index
+        self.expires = expires
+
+
+class ChallengeStore:
+    """
+    In-memory store of issued challenges (answer and correct index) with per-entry expiry.
+    Ids are kept as 16 byte digests, expiry times in a heap so a sweep only touches expired entries.
+    """
+    def __init__(self, ttl=600, max_entries=1000000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._records = {}
+        self._heap = [] # (expires, key), may hold keys that were already popped
+        self._answer_bytes = 0
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _key(cid):
+        return hashlib.blake2b(cid.encode(), digest_size=16).digest()
+
+    def issue(self, prefix, answer, index):
+        cid = prefix + secrets.token_urlsafe(32)
+        self._put(cid, answer, index)
+        return cid
+
+    def _put(self, cid, answer, index, ttl=None):
+        key = self._key(cid)
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._sweep(time.monotonic())
+            old = self._records.get(key)
+            if old is not None:
+                self._answer_bytes -= sys.getsizeof(old.answer)
+            self._records[key] = _Record(answer, index, expires)
+            self._answer_bytes += sys.getsizeof(answer)
+            heapq.heappush(self._heap, (expires, key))
+            while len(self._records) > self.max_entries:
+                if self._drop_next():
+                    self.evicted += 1
+
+    def pop(self, cid):
+        """
+        Removes the challenge and returns (answer, index), or None if it does not exist or expired.
+        """
+        key = self._key(cid)
+        with self._lock:
+            record = self._records.pop(key, None)
+            if record is None:
+                return None
+            self._answer_bytes -= sys.getsizeof(record.answer)
+            if record.expires <= time.monotonic():
+                self.expired += 1
+                return None
+            return record.answer, record.index
+
+    def peek(self, cid):
+        record = self._records.get(self._key(cid))
+        if record is None or record.expires <= time.monotonic():
+            return None
+        return record.answer, record.index
+
+    def __contains__(self, cid):
+        record = self._records.get(self._key(cid))
+        return record is not None and record.expires > time.monotonic()
+
+    def __len__(self):
+        return len(self._records)
+
+    def sweep(self):
+        with self._lock:
+            return self._sweep(time.monotonic())
+
+    def _sweep(self, now):
+        removed = 0
+        while self._heap and self._heap[0][0] <= now:
+            if self._drop_next():
+                self.expired += 1
+                removed += 1
+        return removed
+
+    def _drop_next(self):
+        # pops the heap head, returns True if it was still a live entry
+        expires, key = heapq.heappop(self._heap)
+        record = self._records.get(key)
+        if record is None or record.expires != expires:
+            return False
+        del self._records[key]
+        self._answer_bytes -= sys.getsizeof(record.answer)
+        return True
+
+    def memory_usage(self):
+        """
+        Approximate bytes used by the store (containers, keys, records and answers).
+        """
+        n = len(self._records)
+        per_entry = sys.getsizeof(b"\0" * 16) + _Record.__basicsize__
+        heap_entry = sys.getsizeof((0.0, b"")) + sys.getsizeof(0.0)
+        return (sys.getsizeof(self._records) + n * per_entry + self._answer_bytes
+                + sys.getsizeof(self._heap) + len(self._heap) * heap_entry)
+
+    def report(self):
+        return {
+            "entries": len(self._records),
+            "memory_bytes": self.memory_usage(),
+            "ttl": self.ttl,
+            "max_entries": self.max_entries,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+class SQLiteChallengeStore:
+    """
+    Challenge store shared between processes through a SQLite database in WAL mode.
+    Every issued id is written at once, so the next request can land on any process.
+    pop is a single atomic DELETE ... RETURNING, expired rows are swept in the background.
+    """
+    def __init__(self, path="challenges.db", ttl=600, max_entries=1000000, sweep_interval=10):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self.expired = 0
+        self.evicted = 0
+        self._returning = sqlite3.sqlite_version_info >= (3, 35, 0)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS challenges (key BLOB PRIMARY KEY, answer TEXT NOT NULL, idx INTEGER NOT NULL, expires REAL NOT NULL) WITHOUT ROWID")
+        db.execute("CREATE INDEX IF NOT EXISTS challenges_expires ON challenges (expires)")
+
+    def _after_fork(self):
+        # sqlite connections and the sweep thread don't carry over into a forked worker, it opens its own
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def _db(self):
+        # sqlite connections can't be shared between threads, so each thread gets its own
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    _key = staticmethod(ChallengeStore._key)
+
+    def issue(self, prefix, answer, index):
+        cid = prefix + secrets.token_urlsafe(32)
+        self._put(cid, answer, index)
+        return cid
+
+    def _put(self, cid, answer, index, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        self._db().execute("INSERT OR REPLACE INTO challenges VALUES (?, ?, ?, ?)", (self._key(cid), answer, index, expires))
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_loop, name="challenge-store-sweep", daemon=True)
+                self._sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except sqlite3.Error as e:
+                print("Warning: challenge store sweep failed:", e)
+
+    def pop(self, cid):
+        key = self._key(cid)
+        now = time.time()
+        db = self._db()
+        if self._returning:
+            row = db.execute("DELETE FROM challenges WHERE key = ? RETURNING answer, idx, expires", (key,)).fetchone()
+        else:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute("SELECT answer, idx, expires FROM challenges WHERE key = ?", (key,)).fetchone()
+            db.execute("DELETE FROM challenges WHERE key = ?", (key,))
+            db.execute("COMMIT")
+        if row is None:
+            return None
+        answer, index, expires = row
+        if expires <= now:
+            self.expired += 1
+            return None
+        return answer, index
+
+    def peek(self, cid):
+        now = time.time()
+        row = self._db().execute("SELECT answer, idx, expires FROM challenges WHERE key = ?", (self._key(cid),)).fetchone()
+        if row is None or row[2] <= now:
+            return None
+        return row[0], row[1]
+
+    def __contains__(self, cid):
+        return self._db().execute("SELECT 1 FROM challenges WHERE key = ? AND expires > ?", (self._key(cid), time.time())).fetchone() is not None
+
+    def __len__(self):
+        return self._db().execute("SELECT COUNT(*) FROM challenges").fetchone()[0]
+
+    def sweep(self):
+        db = self._db()
+        removed = db.execute("DELETE FROM challenges WHERE expires <= ?", (time.time(),)).rowcount
+        self.expired += removed
+        excess = db.execute("SELECT COUNT(*) FROM challenges").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.evicted += db.execute("DELETE FROM challenges WHERE key IN (SELECT key FROM challenges ORDER BY expires LIMIT ?)", (excess,)).rowcount
+        return removed
+
+    def report(self):
+        db = self._db()
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        page_count = db.execute("PRAGMA page_count").fetchone()[0]
+        return {
+            "entries": len(self),
+            "db_bytes": page_size * page_count,
+            "ttl": self.ttl,
+            "max_entries": self.max_entries,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+class SignedChallengeStore:
+    """
+    Stateless challenge ids. The id is prefix + an encrypted and authenticated token holding the
+    answer, the correct index and the expiry, so verifying needs no lookup.
+    Single use is enforced with a bloom filter per expiry time bucket, which is local to the process.
+    """
+    def __init__(self, secret, ttl=600, filter_bits=1 << 23):
+        secret = secret.encode() if isinstance(secret, str) else secret
+        self._enc_key = hmac.new(secret, b"tinac challenge id encryption", hashlib.sha256).digest()
+        self._mac_key = hmac.new(secret, b"tinac challenge id authentication", hashlib.sha256).digest()
+        self.ttl = ttl
+        self.filter_bits = filter_bits
+        self._buckets = {} # expiry bucket -> bloom filter bits of ids used in it
+        self._lock = threading.Lock()
+        self.used = 0
+        self.expired = 0
+        self.rejected = 0
+
+    def _keystream(self, nonce, length):
+        blocks = [hmac.new(self._enc_key, nonce + struct.pack(">I", i), hashlib.sha256).digest() for i in range(-(-length // 32))]
+        return b"".join(blocks)[:length]
+
+    @staticmethod
+    def _xor(data, stream):
+        return (int.from_bytes(data, "big") ^ int.from_bytes(stream, "big")).to_bytes(len(data), "big")
+
+    def issue(self, prefix, answer, index):
+        answer = answer.encode()
+        # pad the answer so the token length does not give away the answer length
+        plain = struct.pack(">IHB", int(time.time() + self.ttl), index, len(answer)) + answer.ljust(-(-len(answer) // 16) * 16, b"\0")
+        nonce = secrets.token_bytes(16)
+        body = nonce + self._xor(plain, self._keystream(nonce, len(plain)))
+        tag = hmac.new(self._mac_key, prefix.encode() + body, hashlib.sha256).digest()[:16]
+        return prefix + base64.urlsafe_b64encode(body + tag).decode().rstrip("=")
+
+    def _open(self, cid):
+        # returns (nonce, expires, answer, index) of a valid token, or None
+        prefix, sep, token = cid.partition("_")
+        if not sep:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        except ValueError:
+            return None
+        if len(raw) < 16 + 7 + 16:
+            return None
+        body, tag = raw[:-16], raw[-16:]
+        if not hmac.compare_digest(tag, hmac.new(self._mac_key, (prefix + sep).encode() + body, hashlib.sha256).digest()[:16]):
+            return None
+        nonce, sealed = body[:16], body[16:]
+        plain = self._xor(sealed, self._keystream(nonce, len(sealed)))
+        expires, index, length = struct.unpack(">IHB", plain[:7])
+        return nonce, expires, plain[7:7 + length].decode(), index
+
+    def _positions(self, nonce):
+        # the nonce is random, so its 4 byte chunks are independent hash values
+        return [int.from_bytes(nonce[i:i + 4], "big") % self.filter_bits for i in range(0, 16, 4)]
+
+    def _seen(self, nonce, expires, mark):
+        bucket = expires // self.ttl
+        with self._lock:
+            bits = self._buckets.get(bucket)
+            if bits is None:
+                if not mark:
+                    return False
+                self._sweep(time.time())
+                bits = self._buckets[bucket] = bytearray(self.filter_bits // 8)
+            positions = self._positions(nonce)
+            seen = all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+            if mark and not seen:
+                for p in positions:
+                    bits[p >> 3] |= 1 << (p & 7)
+                self.used += 1
+            return seen
+
+    def pop(self, cid):
+        opened = self._open(cid)
+        if opened is None:
+            self.rejected += 1
+            return None
+        nonce, expires, answer, index = opened
+        if expires <= time.time():
+            self.expired += 1
+            return None
+        if self._seen(nonce, expires, mark=True):
+            return None
+        return answer, index
+
+    def peek(self, cid):
+        opened = self._open(cid)
+        if opened is None or opened[1] <= time.time() or self._seen(opened[0], opened[1], mark=False):
+            return None
+        return opened[2], opened[3]
+
+    def __contains__(self, cid):
+        opened = self._open(cid)
+        return opened is not None and opened[1] > time.time() and not self._seen(opened[0], opened[1], mark=False)
+
+    def __len__(self):
+        return 0 # nothing is stored per challenge
+
+    def sweep(self):
+        with self._lock:
+            return self._sweep(time.time())
+
+    def _sweep(self, now):
+        # a bucket can go once every id that can land in it has expired
+        old = [bucket for bucket in self._buckets if (bucket + 1) * self.ttl <= now]
+        for bucket in old:
+            del self._buckets[bucket]
+        return len(old)
+
+    def report(self):
+        return {
+            "entries": 0,
+            "memory_bytes": len(self._buckets) * self.filter_bits // 8,
+            "filter_buckets": len(self._buckets),
+            "ttl": self.ttl,
+            "used": self.used,
+            "expired": self.expired,
+            "rejected": self.rejected,
+        }
+
+
+def create_store(config):
+    """
+    Builds the challenge store selected by "challenge_store" in config.json.
+    """
+    kind = config.get("challenge_store", "memory")
+    ttl = config.get("challenge_ttl", 600)
+    max_entries = config.get("max_challenges", 1000000)
+    if kind == "memory":
+        return ChallengeStore(ttl=ttl, max_entries=max_entries)
+    if kind == "sqlite":
+        return SQLiteChallengeStore(
+            config.get("challenge_store_path", "challenges.db"),
+            ttl=ttl,
+            max_entries=max_entries,
+        )
+    if kind == "signed":
+        return SignedChallengeStore(config["jwt_secret"], ttl=ttl, filter_bits=config.get("seen_filter_bits", 1 << 23))
+    return importlib.import_module(kind).create_store(config)
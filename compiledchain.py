@@ -0,0 +1,156 @@
+"""
+Compiled, count based format for the 1D markov chain (model.json -> model.bin).
+
+States are interned as integers (their index in sorted order) and each state keeps its distinct
+successors with cumulative counts, plus the id of the state the chain moves to after emitting them.
+The file is little endian and is memory-mapped as is:
+    magic b"TMC1", u32 order, u32 n_states, u32 n_edges
+    offsets    (n_states + 1) x u32   edges of state i are offsets[i]:offsets[i+1]
+    cumulative n_edges x u32          running successor count inside each state
+    next_state n_edges x i32          state after emitting the edge's char, -1 if that state was never seen
+    symbol     n_edges x u8           the emitted char (latin-1)
+    states     n_states x order bytes sorted, used to look up a state by its text
+Usage: python compiledchain.py [model.json] [model.bin]
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+from bisect import bisect_right
+from collections import Counter
+
+MAGIC = b"TMC1"
+HEADER = struct.Struct("<4sIII")
+
+
+def compile_model(model, order, path="model.bin"):
+    """
+    Writes a compiled model from a {state: [successor chars]} dict (the model.json format).
+    """
+    compile_counts({state: Counter(chars) for state, chars in model.items()}, order, path)
+
+
+def compile_counts(counts, order, path="model.bin"):
+    """
+    Writes a compiled model from {state: {successor char: count}}, as counted by trainchain.py.
+    """
+    states = sorted(k.encode("latin-1") for k in counts)
+    ids = {s: i for i, s in enumerate(states)}
+    offsets, cumulative, next_state, symbols = [0], [], [], bytearray()
+    for state in states:
+        running = 0
+        for char, count in sorted(counts[state.decode("latin-1")].items()):
+            running += count
+            code = char.encode("latin-1")
+            cumulative.append(running)
+            next_state.append(ids.get(state[1:] + code, -1))
+            symbols += code
+        offsets.append(len(cumulative))
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, order, len(states), len(cumulative)))
+        f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        f.write(struct.pack(f"<{len(cumulative)}I", *cumulative))
+        f.write(struct.pack(f"<{len(next_state)}i", *next_state))
+        f.write(symbols)
+        f.write(b"".join(states))
+    os.replace(tmp, path)
+
+
+def compile_json(json_path="model.json", bin_path="model.bin"):
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    compile_model(data["model"], data["order"], bin_path)
+
+
+class CompiledMarkovChain:
+    """
+    Generates text from a compiled model with the same distribution as AsciiMarkovChain.generate.
+    """
+    def __init__(self, path="model.bin"):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.order, self.n_states, n_edges = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a compiled markov model")
+        view = memoryview(self._mm)
+        pos = HEADER.size
+        self.offsets = view[pos:pos + 4 * (self.n_states + 1)].cast("I")
+        pos += 4 * (self.n_states + 1)
+        self.cumulative = view[pos:pos + 4 * n_edges].cast("I")
+        pos += 4 * n_edges
+        self.next_state = view[pos:pos + 4 * n_edges].cast("i")
+        pos += 4 * n_edges
+        self.symbols = view[pos:pos + n_edges]
+        pos += n_edges
+        self.states = view[pos:pos + self.n_states * self.order]
+
+    def _lookup(self, text):
+        # binary search over the sorted states, -1 if text is not a state
+        lo, hi, order = 0, self.n_states, self.order
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self.states[mid * order:(mid + 1) * order]) < text:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_states and self.states[lo * order:(lo + 1) * order] == text:
+            return lo
+        return -1
+
+    def generate(self, length=1000):
+        # produce exactly `length` characters in the returned string
+        if length <= 0:
+            return ""
+        return self._generate(length, memoryview(os.urandom(8 * length)).cast("Q"))
+
+    def generate_many(self, length, count):
+        """
+        Generates `count` independent strings of `length` chars from one batch of random numbers.
+        """
+        if length <= 0:
+            return [""] * count
+        rand = memoryview(os.urandom(8 * length * count)).cast("Q")
+        return [self._generate(length, rand[k * length:(k + 1) * length]) for k in range(count)]
+
+    def _generate(self, length, rand):
+        order = self.order
+        offsets, cumulative, next_state, symbols = self.offsets, self.cumulative, self.next_state, self.symbols
+        buf = bytearray(max(length, order))
+        # 64 bit random numbers so the modulo bias is negligible, topped up when resets use some
+        r = 0
+        state = rand[r] % self.n_states
+        r += 1
+        buf[:order] = self.states[state * order:(state + 1) * order]
+        n = order
+        reset = False
+        while n < length:
+            if r >= len(rand):
+                rand = memoryview(os.urandom(8 * length)).cast("Q")
+                r = 0
+            if state < 0:
+                # the last `order` chars were never seen in training, continue from a random state
+                state = rand[r] % self.n_states
+                r += 1
+                reset = True
+                continue
+            lo, hi = offsets[state], offsets[state + 1]
+            edge = bisect_right(cumulative, rand[r] % cumulative[hi - 1], lo, hi)
+            r += 1
+            buf[n] = symbols[edge]
+            n += 1
+            if reset:
+                # after a reset the chain continues from the real tail of the output, not the random state
+                state = self._lookup(bytes(buf[n - order:n]))
+                reset = False
+            else:
+                state = next_state[edge]
+        return buf[:length].decode("latin-1")
+
+
+if __name__ == "__main__":
+    json_path = sys.argv[1] if len(sys.argv) > 1 else "model.json"
+    bin_path = sys.argv[2] if len(sys.argv) > 2 else "model.bin"
+    compile_json(json_path, bin_path)
+    print(f"Compiled {json_path} to {bin_path}")
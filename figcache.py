@@ -0,0 +1,49 @@
+"""
+Cached FIGlet rendering shared by backend.py, trainchain.py and trainchain2d.py.
+Each font is parsed once and each (text, font) pair is rendered once, asciiart() then only
+joins the cached rows.
+"""
+import pyfiglet
+
+_fonts = {}
+_blocks = {}
+
+
+def _figlet(font):
+    figlet = _fonts.get(font)
+    if figlet is None:
+        try:
+            figlet = pyfiglet.Figlet(font=font)
+        except pyfiglet.FontNotFound:
+            print(f"Warning: FIGlet font {font} not found, using standard.")
+            figlet = pyfiglet.Figlet(font="standard")
+        _fonts[font] = figlet
+    return figlet
+
+
+def render(text, font):
+    """
+    Returns the lines of figlet_format(text, font) as a tuple.
+    """
+    block = _blocks.get((text, font))
+    if block is None:
+        block = _blocks[(text, font)] = tuple(_figlet(font).renderText(text).splitlines())
+    return block
+
+
+def preload(fonts, chars):
+    for font in fonts:
+        for char in chars:
+            render(char, font)
+
+
+def asciiart(text_font_pairs):
+    all_blocks = [render(text, font) for text, font in text_font_pairs]
+    if not all_blocks: return ""
+    max_height = max(len(block) for block in all_blocks)
+    padded = []
+    for block in all_blocks:
+        if len(block) < max_height:
+            block = block + (" " * len(block[0]) if block else "",) * (max_height - len(block))
+        padded.append(block)
+    return "".join("".join(row) + "\n" for row in zip(*padded))
@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+
+
+class FrameCache:
+    """
+    Encoded frames of lazy audio challenges, grouped per challenge id. Holds at most max_frames frames,
+    when it is full the challenge used least recently is dropped with all its frames.
+    Frames are stored per challenge, all at once, and a dropped challenge is built again from the same seeds,
+    so it only costs time.
+    """
+    def __init__(self, max_frames=512):
+        self.max_frames = max(0, int(max_frames))
+        self._challenges = OrderedDict() # cid -> {index: bytes}
+        self._frames = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cid, index):
+        with self._lock:
+            frames = self._challenges.get(cid)
+            data = frames.get(index) if frames is not None else None
+            if data is None:
+                self.misses += 1
+                return None
+            self._challenges.move_to_end(cid)
+            self.hits += 1
+            return data
+
+    def put(self, cid, frames):
+        """
+        Stores all frames of challenge cid. A challenge with more frames than max_frames is not kept.
+        """
+        if len(frames) > self.max_frames:
+            return
+        with self._lock:
+            dropped = self._challenges.pop(cid, None)
+            if dropped is not None:
+                self._frames -= len(dropped)
+            self._challenges[cid] = dict(enumerate(frames))
+            self._frames += len(frames)
+            while self._frames > self.max_frames:
+                _, dropped = self._challenges.popitem(last=False)
+                self._frames -= len(dropped)
+
+    def discard(self, cid):
+        # the challenge was answered, its frames won't be asked for again
+        with self._lock:
+            frames = self._challenges.pop(cid, None)
+            if frames is not None:
+                self._frames -= len(frames)
+
+    def clear(self):
+        with self._lock:
+            self._challenges.clear()
+            self._frames = 0
+
+    def report(self):
+        with self._lock:
+            return {"challenges": len(self._challenges), "frames": self._frames, "max_frames": self.max_frames, "hits": self.hits, "misses": self.misses}
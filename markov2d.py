@@ -1,20 +1,102 @@
 import json
 import secrets
 import os
+from array import array
+from bisect import bisect_right
+from collections import Counter
 
 class DecoyEngine:
     def __init__(self, model_path="model2d.json"):
-        self.rules = {}
+        self.counts = {} # "left,up,upleft" ordinals -> {char: count}
         self.load_model(model_path)
         
     def load_model(self, path):
         if not os.path.exists(path):
             print(f"Warning: {path} not found. Decoys will be blank.")
+            self._compile()
             return
 
         with open(path, "r") as f:
             data = json.load(f)
-            self.rules = data["rules"]
+        if "counts" in data:
+            self.counts = data["counts"]
+        else:
+            # older models list every observed char, count them
+            self.counts = {key: Counter(chars) for key, chars in data["rules"].items()}
+        self._compile()
+
+    def _compile(self):
+        """
+        Turns the counts into flat tables. Every char gets an integer id, a (left, up, upleft)
+        context becomes the dense index (left*S + up)*S + upleft, and each context keeps its
+        distinct successors with cumulative counts in offsets/cumulative/successors.
+        """
+        symbols = {" "}
+        for key, chars in self.counts.items():
+            symbols.update(chr(int(o)) for o in key.split(","))
+            symbols.update(chars)
+        self.symbols = sorted(symbols)
+        ids = {c: i for i, c in enumerate(self.symbols)}
+        size = len(self.symbols)
+        self.space = ids[" "]
+        contexts = {}
+        for key, chars in self.counts.items():
+            left, up, upleft = (ids[chr(int(o))] for o in key.split(","))
+            contexts[(left * size + up) * size + upleft] = sorted(chars.items())
+        self.offsets = array("I", [0])
+        self.cumulative = array("I")
+        self.successors = array("I")
+        for ctx in range(size ** 3):
+            running = 0
+            for char, count in contexts.get(ctx, ()):
+                running += count
+                self.cumulative.append(running)
+                self.successors.append(ids[char])
+            self.offsets.append(len(self.cumulative))
+
+    def generate(self, linelen, rows):
+        """
+        Generates `rows` rows of `linelen` chars with the same distribution as calling get_char per cell.
+        Returns the rows as strings.
+        """
+        return self.generate_blocks(linelen, rows, 1)[0]
+
+    def generate_blocks(self, linelen, rows, count):
+        """
+        Generates `count` independent blocks (lists of row strings) like generate().
+        """
+        size = len(self.symbols)
+        size2 = size * size
+        space = self.space
+        offsets, cumulative, successors = self.offsets, self.cumulative, self.successors
+        # one 64 bit number per cell of every block, only cells with several successors use theirs.
+        # rand[r] % total weight of the context is biased by at most total/2**64
+        rand = memoryview(os.urandom(8 * max(1, linelen * rows * count))).cast("Q")
+        r = 0
+        out = []
+        for row_index in range(rows * count):
+            if row_index % max(1, rows) == 0:
+                prev = [space] * linelen # each block starts with blank neighbours
+            # the (up, upleft) part of every context in this row only depends on the previous row
+            above = [prev[c] * size + (prev[c - 1] if c > 0 else space) for c in range(linelen)]
+            row = [space] * linelen
+            left = space
+            for c in range(linelen):
+                ctx = left * size2 + above[c]
+                lo, hi = offsets[ctx], offsets[ctx + 1]
+                if lo == hi:
+                    left = space
+                elif hi - lo == 1:
+                    left = successors[lo]
+                else:
+                    left = successors[bisect_right(cumulative, rand[r] % cumulative[hi - 1], lo, hi)]
+                    r += 1
+                row[c] = left
+            out.append(row)
+            prev = row
+        symbols = self.symbols
+        lines = ["".join([symbols[i] for i in row]) for row in out]
+        return [lines[k * rows:(k + 1) * rows] for k in range(count)]
 
     def get_char(self, left, up, upleft):
         """
@@ -22,12 +104,15 @@ class DecoyEngine:
         """
         key = f"{ord(left)},{ord(up)},{ord(upleft)}"
         
-        possible_chars = self.rules.get(key)
+        possible_chars = self.counts.get(key)
         
         if possible_chars:
-            return secrets.choice(possible_chars)
-        else:
-            return " " 
+            pick = secrets.randbelow(sum(possible_chars.values()))
+            for char, count in sorted(possible_chars.items()):
+                if pick < count:
+                    return char
+                pick -= count
+        return " " 
 
 _engine = DecoyEngine()
 def generate_decoy(linelen, lineheight, realtext):
@@ -40,13 +125,11 @@ def generate_decoy(linelen, lineheight, realtext):
         realtext (str): Ignored for generation content (as requested), 
                         but could be used for logging/metrics if needed.
     """
-    grid = [[" " for _ in range(linelen)] for _ in range(lineheight-1)]
-    
-    for r in range(lineheight-1): #TODO find out why i need to put -1 
-        for c in range(linelen):
-            left   = grid[r][c-1] if c > 0 else " "
-            up     = grid[r-1][c] if r > 0 else " "
-            upleft = grid[r-1][c-1] if (r > 0 and c > 0) else " "
-            char = _engine.get_char(left, up, upleft)
-            grid[r][c] = char
-    return "\n".join("".join(row) for row in grid)
\ No newline at end of file
+    #TODO find out why i need to put -1 
+    return "\n".join(_engine.generate(linelen, lineheight-1))
+
+def generate_decoys(linelen, lineheight, realtext, count):
+    """
+    Batch version of generate_decoy, returns `count` decoys.
+    """
+    return ["\n".join(block) for block in _engine.generate_blocks(linelen, lineheight-1, count)]
@@ -0,0 +1,156 @@
+"""
+Minimal Prometheus metrics (text format 0.0.4) for GET /metrics, without a client library.
+Observing is a lock and a few integer adds, so it stays on in production.
+Metrics are per process: with process_workers, the stage timings of builds done in the
+worker processes are sent back with each challenge and merged (see backend._build_in_process).
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# seconds, from a cached FIGlet render to a slow mp3 encode
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {} # label values -> [per bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # another thread may have held the lock while a build process was forked
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def time(self, *labels):
+        """
+        with histogram.time("stage"): ... observes how long the block took.
+        """
+        return _Timer(self, labels)
+
+    def state(self):
+        with self._lock:
+            return {labels: list(series) for labels, series in self._series.items()}
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def merge(self, state):
+        with self._lock:
+            for labels, other in state.items():
+                series = self._series.get(labels)
+                if series is None:
+                    self._series[labels] = list(other)
+                    continue
+                for i, value in enumerate(other):
+                    series[i] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self.state().items()):
+            running = 0
+            for bound, count in zip(self.buckets, series):
+                running += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {running}")
+            running += series[len(self.buckets)]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {running}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {running}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f"{self.name}{_labels(self.labelnames, labels)} {value}" for labels, value in values)
+        return lines
+
+
+class Gauge:
+    """
+    Read when /metrics is scraped, from a function returning {label values: value}.
+    """
+    def __init__(self, name, help, labelnames=(), read=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.read = read
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.read() if self.read is not None else {}
+        except Exception as e:
+            print(f"Warning: could not read gauge {self.name}:", e)
+            values = {}
+        lines.extend(f"{self.name}{_labels(self.labelnames, labels)} {value}" for labels, value in sorted(values.items()) if value is not None)
+        return lines
+
+
+stage_seconds = Histogram("tinac_stage_seconds", "Time spent in each stage of building and checking challenges.", ["stage"])
+registry = [stage_seconds]
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,51 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class VerifiedTokenCache:
+    """
+    LRU of tokens that already passed jwt.decode, so checking the same cookie again skips the
+    signature check and JSON parsing. An entry is dropped once its token's exp has passed,
+    so an expired token is never answered from the cache.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max(0, int(max_entries))
+        self._entries = OrderedDict() # token -> (payload, exp)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        """
+        Returns the decoded payload, or None if the token is not cached (or just expired).
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token, payload):
+        exp = payload.get("exp")
+        if self.max_entries == 0 or not isinstance(exp, (int, float)):
+            return # tokens without exp are not cached, there is no point where they stop being valid
+        with self._lock:
+            self._entries[token] = (payload, exp)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def report(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
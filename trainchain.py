@@ -1,16 +1,21 @@
 """Train the Markov Chain to generate fake ASCII art."""
-import pyfiglet
+from figcache import asciiart, preload
 import random  #Seeded by secrets for security
 import secrets #Generates seeds
 import random
-from collections import defaultdict
+from collections import defaultdict, Counter
 import json
+import argparse
+import os
+from multiprocessing import Pool
+from compiledchain import compile_counts, CompiledMarkovChain
 with open("config.json","r") as f:
     config=json.load(f)
     chars=config["chars"] #Confusing chars may make the captcha hard so those are removed
     good_fonts=config["good_fonts"]
     order=config["training_settings"]["memory"]
     examples=config["training_settings"]["examples"]
+preload(good_fonts,chars)
 class AsciiMarkovChain:
     def __init__(self, corpus=None, order=5):
         self.order = order
@@ -58,52 +63,71 @@ class AsciiMarkovChain:
         return instance
 
 #generate the corpus!
-def asciiart(text_font_pairs):
-    all_blocks = []
-    for text, font in text_font_pairs:
-        art = pyfiglet.figlet_format(text, font=font)
-        all_blocks.append(art.splitlines())
-    max_height = max(len(block) for block in all_blocks)
-    for block in all_blocks:
-        while len(block) < max_height:
-            block.append(" " * len(block[0]) if block else "")
-    ans = ""
-    for i in range(max_height):
-        combined_line = "".join(block[i] for block in all_blocks)
-        ans += combined_line + "\n"
-    return ans
-try:
-    
-    print(asciiart([("Starting...","standard")]))
-    print("Press Ctrl+C to stop.")
-    corpus = ""
-    print("- Seeding RNG... (1/4)")
-    rng = random.Random(secrets.randbits(64))
-    print(f"\033[A\033[0;32;49m- Generating random text (2/4) 0/{examples}")
+def get_challenge(rng):
+    challenge="".join(rng.choice(chars) for _ in range(rng.choice([5,6,7])))
+    fonts=[rng.choice(good_fonts) for _ in range(len(challenge))]
+    ctext = asciiart(list(zip(challenge, fonts))).replace("\n","")
+    return ctext
+
+def count_shard(job):
+    """
+    Generates `examples` challenges and counts {state: {next char: count}} over them, as if they were
+    one corpus. Only the last `order` chars are carried from one example to the next, so memory
+    depends on the number of distinct states, not on the number of examples.
+    """
+    seed,examples=job
+    rng = random.Random(seed)
+    counts = defaultdict(Counter)
+    tail = ""
+    for _ in range(examples):
+        text = tail + get_challenge(rng)
+        for i in range(len(text) - order):
+            counts[text[i : i + order]][text[i + order]] += 1
+        tail = text[-order:]
+    return examples, dict(counts)
 
-    def get_challenge():
-        global rng
-        challenge="".join(rng.choice(chars) for _ in range(rng.choice([5,6,7])))
-        fonts=[rng.choice(good_fonts) for _ in range(len(challenge))]
-        ctext = asciiart(list(zip(challenge, fonts))).replace("\n","")
-        return ctext
-    for i in range(examples):
-        corpus += get_challenge()
-        if i % 19 == 0:
-            print(f"\033[A- Generating random text (2/4) {i+1}/{examples}")
-    print("\033[A- Training Markov Chain... (3/4)")
-    markov_chain = AsciiMarkovChain(corpus, order=order)
-    print("\033[A- Saving model to model.json... (4/4)")
-    markov_chain.save_to_json("model.json")
+def train(workers, shard_size, write_json=False):
+    print("- Seeding RNG... (1/4)")
+    jobs = []
+    for start in range(0, examples, shard_size):
+        jobs.append((secrets.randbits(64), min(shard_size, examples - start)))
+    print(f"\033[A\033[0;32;49m- Generating random text and counting (2/4) 0/{examples}")
+    counts = defaultdict(Counter)
+    done = 0
+    with Pool(workers) as pool:
+        # imap_unordered hands back each shard's table as soon as it is counted, and it is
+        # dropped once added in, so memory stays at the merged table plus the shards in flight
+        for shard_examples, shard in pool.imap_unordered(count_shard, jobs):
+            for state, successors in shard.items():
+                counts[state].update(successors)
+            done += shard_examples
+            print(f"\033[A- Generating random text and counting (2/4) {done}/{examples}")
+    print(f"\033[A- Compiling {len(counts)} states... (3/4)                  ")
+    print("\033[A- Saving model to model.bin... (4/4)        ")
+    compile_counts(counts, order, "model.bin")
+    if write_json:
+        markov_chain = AsciiMarkovChain(order=order)
+        markov_chain.model = defaultdict(list, {state: [c for c, n in sorted(successors.items()) for _ in range(n)] for state, successors in counts.items()})
+        markov_chain.save_to_json("model.json")
+        os.utime("model.bin") # keep model.bin newer, so the server doesn't recompile it from model.json
     print("\033[1;92;49mCompleted training and saved model successfully.\033[0;39;49m")
-    print("Test generation: (this should be giberrish)")
-    initgen = markov_chain.generate(200)
-    testgen = ""
-    #split into line length 40 (in an actual generation this would be the same as the real one)
-    for i in range(0, len(initgen), 40):
-        testgen += initgen[i:i+40] + "\n"
-    print(testgen)
-except KeyboardInterrupt:
-    exit(0)
-except Exception as e:
-    raise e
\ No newline at end of file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the 1D markov deceptor and write model.bin.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processes that generate and count examples (default: number of CPUs)")
+    parser.add_argument("--shard-size", type=int, default=config["training_settings"].get("shard_size", 500), help="examples per work unit")
+    parser.add_argument("--json", action="store_true", help="also write model.json in the old list format (large)")
+    args = parser.parse_args()
+    try:
+        print(asciiart([("Starting...","standard")]))
+        print("Press Ctrl+C to stop.")
+        train(max(1, args.workers), max(1, args.shard_size), args.json)
+        print("Test generation: (this should be giberrish)")
+        initgen = CompiledMarkovChain("model.bin").generate(200)
+        testgen = ""
+        #split into line length 40 (in an actual generation this would be the same as the real one)
+        for i in range(0, len(initgen), 40):
+            testgen += initgen[i:i+40] + "\n"
+        print(testgen)
+    except KeyboardInterrupt:
+        exit(0)
@@ -1,7 +1,10 @@
 import json
+import os
+import argparse
 import secrets
-import pyfiglet
-from collections import defaultdict
+from multiprocessing import Pool
+from figcache import asciiart, preload
+from collections import defaultdict, Counter
 
 # --- CONFIG LOADING ---
 def load_config(path="config.json"):
@@ -10,41 +13,16 @@ def load_config(path="config.json"):
 
 CONFIG = load_config()
 
-def asciiart(text_font_pairs): 
-    all_blocks = []
-    for text, font in text_font_pairs:
-        try:
-            art = pyfiglet.figlet_format(text, font=font)
-        except:
-            art = pyfiglet.figlet_format(text, font="standard")
-        all_blocks.append(art.splitlines())
-    
-    if not all_blocks: return ""
-
-    max_height = max(len(block) for block in all_blocks)
-    for block in all_blocks:
-        while len(block) < max_height:
-            block.append(" " * len(block[0]) if block else "")
-            
-    ans = ""
-    for i in range(max_height):
-        combined_line = "".join(block[i] for block in all_blocks if i < len(block))
-        ans += combined_line + "\n"
-    return ans
-
-def generate_training_corpus():
-    """Generates a massive string of random CAPTCHA-like text."""
-    print("Generating training corpus...")
+def generate_training_corpus(num_examples):
+    """Generates `num_examples` random CAPTCHA-like texts, returns their lines."""
     corpus_lines = []
     
-    num_examples = CONFIG["training_settings"]["examples"]
     chars = CONFIG["chars"]
     charlens = CONFIG["charlens"]
     good_fonts = CONFIG["good_fonts"]
+    preload(good_fonts, chars)
 
     for i in range(num_examples):
-        if i % 100 == 0: print(f"Generated {i}/{num_examples} examples...")
-        
         word_len = secrets.choice(charlens)
         challenge_text = "".join(secrets.choice(chars) for _ in range(word_len))
         fonts = [secrets.choice(good_fonts) for _ in range(len(challenge_text))]
@@ -59,37 +37,61 @@ def generate_training_corpus():
     return corpus_lines
 
 # --- 2D MARKOV TRAINING ---
-def train():
-    lines = generate_training_corpus()
+def count_shard(num_examples):
+    """
+    Counts {(left, up, upleft) key: {char: count}} over a corpus of `num_examples` examples.
+    Each shard is its own grid (padded to its widest line), so memory depends on the shard size
+    and the number of distinct contexts, not on the total number of examples.
+    """
+    lines = generate_training_corpus(num_examples)
     
     # Pad lines to form a perfect grid 
-    if not lines: return
+    counts = defaultdict(Counter)
+    if not lines: return num_examples, {}, 0
     max_width = max(len(l) for l in lines)
     grid = [line.ljust(max_width) for line in lines]
     height = len(grid)
     
-    model = defaultdict(list)
-    order = CONFIG["training_settings"].get("memory", 3) # unused in 2d
-    
-    print("Analyzing 2D patterns...")
-    
     for r in range(1, height):
+        row, above = grid[r], grid[r-1]
         for c in range(1, max_width):
-            curr = grid[r][c]
+            curr = row[c]
             
             # use ordinals (ascii codes) for the key to avoid json escaping issues with \ or "
-            left_char = grid[r][c-1]
-            up_char   = grid[r-1][c]
-            upleft_char = grid[r-1][c-1]
+            left_char = row[c-1]
+            up_char   = above[c]
+            upleft_char = above[c-1]
             key = f"{ord(left_char)},{ord(up_char)},{ord(upleft_char)}"
             
-            model[key].append(curr)
+            counts[key][curr] += 1
+
+    return num_examples, dict(counts), max_width
+
+def train(workers=None, shard_size=None):
+    num_examples = CONFIG["training_settings"]["examples"]
+    if shard_size is None:
+        shard_size = CONFIG["training_settings"].get("shard_size", 500)
+    shards = [min(shard_size, num_examples - start) for start in range(0, num_examples, shard_size)]
+    
+    print("Generating training corpus and analyzing 2D patterns...")
+    counts = defaultdict(Counter)
+    max_width = 0
+    done = 0
+    with Pool(workers) as pool:
+        # the widest shard decides the model's max_width, everything else is summed per context key
+        for shard_examples, shard, width in pool.imap_unordered(count_shard, shards):
+            for key, successors in shard.items():
+                counts[key].update(successors)
+            max_width = max(max_width, width)
+            done += shard_examples
+            print(f"Counted {done}/{num_examples} examples...")
 
     final_model = {
-        "rules": dict(model),
+        "counts": {key: dict(successors) for key, successors in counts.items()},
         "meta": {
             "avg_width": max_width, # Just for reference
-            "description": "2D Markov Chain (Left, Up, UpLeft)"
+            "description": "2D Markov Chain (Left, Up, UpLeft)",
+            "format": "counts"
         }
     }
 
@@ -99,4 +101,8 @@ def train():
     print("Training complete. Saved to model2d.json")
 
 if __name__ == "__main__":
-    train()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Train the 2D markov deceptor and write model2d.json.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processes that generate and count examples (default: number of CPUs)")
+    parser.add_argument("--shard-size", type=int, default=None, help="examples per work unit (default: training_settings.shard_size or 500)")
+    args = parser.parse_args()
+    train(max(1, args.workers), max(1, args.shard_size) if args.shard_size else None)
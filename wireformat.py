@@ -0,0 +1,70 @@
+"""
+Binary framing for /challenge_img and /challenge_audio, sent instead of the JSON shape when the
+client asks for it with "Accept: application/octet-stream".
+Everything is little endian:
+    magic b"TNB1", u8 kind (1 image, 2 audio), u8 reserved (0),
+    u16 width, u16 height, u16 count, u16 steps, u16 id_len, u32 n_parts   (20 bytes)
+    id         id_len bytes (ascii)
+    offsets    (n_parts + 1) x u32, part i is payload[offsets[i]:offsets[i+1]]
+    payload    the parts back to back
+An image bundle has one part (the zlib blob, same as the base64 "data" in JSON) and width/height set.
+An audio challenge has one audio file per frame (mp3, or WAV starting with b"RIFF" with audio_format wav/ulaw)
+and width = height = 0.
+A lazy audio challenge has no parts (count = steps), its frames are fetched from /challenge_audio/{id}/{index}.
+"""
+import struct
+
+MAGIC = b"TNB1"
+HEADER = struct.Struct("<4sBBHHHHHI")
+KIND_IMAGE = 1
+KIND_AUDIO = 2
+MEDIA_TYPE = "application/octet-stream"
+
+
+def encode(kind, cid, parts, steps, width=0, height=0, count=None):
+    cid = cid.encode("ascii")
+    offsets = [0]
+    for part in parts:
+        offsets.append(offsets[-1] + len(part))
+    return b"".join([
+        HEADER.pack(MAGIC, kind, 0, width, height, len(parts) if count is None else count, steps, len(cid), len(parts)),
+        cid,
+        struct.pack(f"<{len(offsets)}I", *offsets),
+        *parts,
+    ])
+
+
+def decode(data):
+    """
+    Returns a dict with kind, id, width, height, count, steps and parts (a list of bytes).
+    """
+    magic, kind, _, width, height, count, steps, id_len, n_parts = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("not a TINAC binary challenge")
+    pos = HEADER.size
+    cid = bytes(data[pos:pos + id_len]).decode("ascii")
+    pos += id_len
+    offsets = struct.unpack_from(f"<{n_parts + 1}I", data, pos)
+    pos += 4 * (n_parts + 1)
+    parts = [bytes(data[pos + offsets[i]:pos + offsets[i + 1]]) for i in range(n_parts)]
+    return {"kind": kind, "id": cid, "width": width, "height": height, "count": count, "steps": steps, "parts": parts}
+
+
+def accepts(accept_header, media_type=MEDIA_TYPE):
+    """
+    True if media_type is listed in an Accept header with a non-zero q.
+    */* alone does not count, so browsers and plain clients keep getting JSON.
+    """
+    for item in (accept_header or "").split(","):
+        fields = item.strip().split(";")
+        if fields[0].strip().lower() != media_type:
+            continue
+        for param in fields[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False